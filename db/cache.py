@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+"""
+查询结果缓存，按sql和参数缓存select的结果，支持TTL、按占用内存的LRU淘汰和按表失效
+"""
+
+import sys
+import time
+from collections import OrderedDict
+
+
+# 估算一组结果行占用的内存，行为tuple或dict
+def sizeof(rows):
+    size = sys.getsizeof(rows)
+    for r in rows:
+        size += sys.getsizeof(r)
+        for v in (r.values() if isinstance(r, dict) else r):
+            size += sys.getsizeof(v)
+    return size
+
+
+class ResultCache(object):
+
+    def __init__(self, max_bytes=16 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # key => (过期时间, 表名, 大小, 结果)，按最近使用排序
+        self._entries = OrderedDict()
+        # 表名 => 该表的所有key
+        self._tables = dict()
+        # 表名 => 失效的次数，清空缓存的次数，用于丢弃失效之前开始的查询结果
+        self._generations = dict()
+        self._cleared = 0
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        if entry[0] < time.time():
+            self._remove(key)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[3]
+
+    # 返回表当前的版本，在查询之前获取，作为put的generation参数
+    def generation(self, table):
+        return self._cleared, self._generations.get(table, 0)
+
+    # generation不为None且表在查询期间已失效时不缓存，避免缓存写入之前读到的结果
+    def put(self, key, table, ttl, rows, generation=None):
+        if generation is not None and generation != self.generation(table):
+            return
+        size = sizeof(rows)
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (time.time() + ttl, table, size, rows)
+        self._tables.setdefault(table, set()).add(key)
+        self.bytes += size
+        # 超出内存预算时淘汰最久未使用的结果
+        while self.bytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def _remove(self, key):
+        expires, table, size, rows = self._entries.pop(key)
+        self.bytes -= size
+        keys = self._tables.get(table)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._tables[table]
+
+    # 使某个表的所有缓存结果失效，table为None时清空缓存
+    def invalidate(self, table=None):
+        if table is None:
+            self._cleared += 1
+            self._entries.clear()
+            self._tables.clear()
+            self.bytes = 0
+            return
+        self._generations[table] = self._generations.get(table, 0) + 1
+        for key in list(self._tables.get(table, ())):
+            self._remove(key)
+
+    def stats(self):
+        return dict(entries=len(self._entries), bytes=self.bytes, max_bytes=self.max_bytes,
+                    hits=self.hits, misses=self.misses, evictions=self.evictions)
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+"""
+开发模式下的查询计划审计：每个sql模板第一次执行时在后台运行EXPLAIN，
+记录执行计划和发起查询的Model方法、handler，标记全表扫描、filesort和临时表，退出时输出汇总报告
+"""
+
+import asyncio
+import contextvars
+import json
+import logging
+import sys
+
+explain_logger = logging.getLogger('orm.explain')
+
+_PACKAGE = __name__.rpartition('.')[0] + '.'
+
+# 由其他task代为执行的查询（例如请求作用域内按主键合并的find），
+# 在发起方记录的(Model方法, handler)，该task中的查询使用它而不是查找调用栈
+origin = contextvars.ContextVar('explain_origin', default=None)
+
+
+# 从EXPLAIN的结果中找出有问题的部分
+def flags(plan):
+    result = []
+    for row in plan:
+        table = row.get('table')
+        if row.get('type') == 'ALL':
+            result.append('full scan on %s (%s rows)' % (table, row.get('rows')))
+        extra = row.get('Extra') or ''
+        if 'Using filesort' in extra:
+            result.append('filesort on %s' % table)
+        if 'Using temporary' in extra:
+            result.append('temporary table on %s' % table)
+    return result
+
+
+# 沿调用栈向外查找，返回(Model方法, handler)，Model方法为最外层的orm调用，
+# handler为第一个db包和asyncio之外的调用
+def caller(frame):
+    method = None
+    while frame is not None:
+        code = frame.f_code
+        module = frame.f_globals.get('__name__', '')
+        if module.startswith('asyncio'):
+            frame = frame.f_back
+            continue
+        if not module.startswith(_PACKAGE):
+            return method, '%s (%s:%s)' % (code.co_name, code.co_filename, frame.f_lineno)
+        owner = frame.f_locals.get('cls') or getattr(frame.f_locals.get('self'), '_model', None)
+        if owner is not None:
+            method = '%s.%s' % (owner.__name__, code.co_name)
+        frame = frame.f_back
+    return method, None
+
+
+class PlanAuditor(object):
+
+    # run为执行EXPLAIN的协程函数，参数为sql和args，返回dict行；report为报告文件的路径，None时只写日志
+    def __init__(self, run, report=None):
+        self.run = run
+        self.report_path = report
+        # sql模板 => dict(plan, flags, method, handler)
+        self.plans = dict()
+        self._tasks = set()
+
+    # 在select中调用，必须在第一次await之前，这样调用栈中还有发起查询的协程
+    def observe(self, sql, args):
+        if sql in self.plans:
+            return
+        method, handler = origin.get() or caller(sys._getframe(1))
+        entry = self.plans[sql] = dict(plan=None, flags=[], method=method, handler=handler)
+        # 在新的上下文中运行，不使用当前请求的事务连接和截止时间
+        task = contextvars.Context().run(asyncio.ensure_future, self._explain(sql, args, entry))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _explain(self, sql, args, entry):
+        try:
+            entry['plan'] = plan = await self.run(sql, args)
+        except Exception as e:
+            entry['error'] = str(e)
+            explain_logger.warning('explain failed: %s, sql: %s' % (e, sql))
+            return
+        entry['flags'] = flags(plan)
+        if entry['flags']:
+            explain_logger.warning('%s, sql: %s, from %s in %s' % ('; '.join(entry['flags']), sql, entry['method'], entry['handler']))
+
+    def snapshot(self):
+        return dict((sql, dict(entry)) for sql, entry in self.plans.items())
+
+    # 输出汇总报告，有问题的模板在前
+    def report(self):
+        flagged = [(sql, e) for sql, e in self.plans.items() if e['flags']]
+        explain_logger.warning('query plan audit: %s templates, %s flagged' % (len(self.plans), len(flagged)))
+        for sql, e in flagged:
+            explain_logger.warning('  %s\n    sql: %s\n    from %s in %s' % ('; '.join(e['flags']), sql, e['method'], e['handler']))
+        if self.report_path:
+            entries = sorted(self.snapshot().items(), key=lambda item: not item[1]['flags'])
+            with open(self.report_path, 'w') as f:
+                json.dump([dict(e, sql=sql) for sql, e in entries], f, indent=2, default=str)
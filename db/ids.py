@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+
+"""
+按时间排序的主键生成器：63位整数 = 41位毫秒时间戳 | 10位worker | 12位毫秒内序号，
+编码为13位定长的base32字符串，字典序与生成顺序一致，插入时按顺序追加到InnoDB聚簇索引的末尾
+"""
+
+import logging
+import os
+import tempfile
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# 时间戳从2015-01-01开始计算，41位毫秒可以使用约69年
+EPOCH = 1420070400000
+WORKER_BITS = 10
+SEQUENCE_BITS = 12
+MAX_WORKER = (1 << WORKER_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+# Crockford base32，去掉了i、l、o、u，小写字母的ASCII码大于数字，保证字典序与数值顺序一致
+ALPHABET = '0123456789abcdefghjkmnpqrstvwxyz'
+LENGTH = 13
+# worker 0保留给迁移旧id使用
+MIGRATION_WORKER = 0
+
+
+def encode(n):
+    chars = []
+    for _ in range(LENGTH):
+        chars.append(ALPHABET[n & 31])
+        n >>= 5
+    return ''.join(reversed(chars))
+
+
+def decode(s):
+    if len(s) != LENGTH:
+        raise ValueError('invalid id: %s' % s)
+    n = 0
+    for c in s:
+        n = (n << 5) | ALPHABET.index(c)
+    return n
+
+
+def make(ms, worker, sequence):
+    return encode(((ms - EPOCH) << (WORKER_BITS + SEQUENCE_BITS)) | (worker << SEQUENCE_BITS) | sequence)
+
+
+# 返回id的生成时间（秒）
+def timestamp(s):
+    return ((decode(s) >> (WORKER_BITS + SEQUENCE_BITS)) + EPOCH) / 1000.0
+
+
+class IdGenerator(object):
+
+    def __init__(self, worker):
+        if not 0 <= worker <= MAX_WORKER:
+            raise ValueError('worker must be between 0 and %s: %s' % (MAX_WORKER, worker))
+        self.worker = worker
+        self._last = 0
+        self._sequence = 0
+
+    # 同一毫秒内序号递增，序号用完或系统时钟回拨时沿用上一个时间戳继续递增，保证单调且不阻塞
+    def next_id(self):
+        ms = int(time.time() * 1000)
+        if ms <= self._last:
+            ms = self._last
+            self._sequence += 1
+            if self._sequence > MAX_SEQUENCE:
+                ms += 1
+                self._sequence = 0
+        else:
+            self._sequence = 0
+        self._last = ms
+        return make(ms, self.worker, self._sequence)
+
+
+# 每个进程的worker必须不同：优先使用配置，其次是环境变量BLOG_WORKER_ID，
+# 都没有时从本机未被占用的worker中租用一个。租用通过lock_dir下每个worker一个文件的排他锁实现，
+# 进程退出时锁自动释放；显式给出的worker同样加锁，同一台机器上重复使用时报错。
+# 锁只在一台机器内有效，多台机器部署时必须为每台机器的进程显式配置不重叠的worker
+def default_worker():
+    worker = os.environ.get('BLOG_WORKER_ID')
+    if worker is not None:
+        return int(worker)
+    return None
+
+
+# 对worker的锁文件加排他锁，成功时返回打开的文件，已被其他进程占用时返回None
+def _lease(worker, lock_dir):
+    f = open(os.path.join(lock_dir, 'blog-id-worker-%d.lock' % worker), 'a')
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        f.close()
+        return None
+    return f
+
+
+_generator = None
+# 当前worker的锁文件，锁文件所在目录，生成器所属的进程，worker是否为显式配置
+_lock = None
+_lock_dir = None
+_pid = None
+_explicit = False
+
+
+def configure(worker=None, lock_dir=None):
+    global _generator, _lock, _lock_dir, _pid, _explicit
+    if worker is None:
+        worker = default_worker()
+    explicit = worker is not None
+    lock_dir = _lock_dir = lock_dir or _lock_dir or tempfile.gettempdir()
+    # 重新配置时释放本进程之前租用的worker，fork继承的锁属于父进程，不能释放
+    if _lock is not None and _pid == os.getpid():
+        _lock.close()
+    _lock = None
+    if fcntl is None:
+        # 无法加锁的平台只能使用显式配置的worker
+        if not explicit:
+            raise RuntimeError('ids: worker must be configured explicitly on this platform')
+    elif explicit:
+        if not 0 <= worker <= MAX_WORKER:
+            raise ValueError('worker must be between 0 and %s: %s' % (MAX_WORKER, worker))
+        _lock = _lease(worker, lock_dir)
+        if _lock is None:
+            raise RuntimeError('ids: worker %s is already used by another process on this host' % worker)
+    else:
+        for candidate in range(MIGRATION_WORKER + 1, MAX_WORKER + 1):
+            _lock = _lease(candidate, lock_dir)
+            if _lock is not None:
+                worker = candidate
+                break
+        else:
+            raise RuntimeError('ids: no free worker in %s' % lock_dir)
+    _generator = IdGenerator(worker)
+    _pid = os.getpid()
+    _explicit = explicit
+    logging.info('id generator worker: %s' % worker)
+
+
+def next_id():
+    if _generator is None:
+        configure()
+    elif _pid != os.getpid():
+        # fork之后子进程不能沿用父进程的worker，租用新的worker，显式配置的worker无法替换，报错
+        if _explicit:
+            raise RuntimeError('ids: worker %s was configured in process %s, configure a distinct worker for process %s'
+                               % (_generator.worker, _pid, os.getpid()))
+        configure()
+    return _generator.next_id()
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+
+"""
+ORM的统计信息：按sql模板汇总的耗时直方图和慢查询日志
+"""
+
+import bisect
+import logging
+
+# 慢查询单独使用一个logger，便于输出到单独的文件
+slow_logger = logging.getLogger('orm.slow')
+
+
+# 固定分桶的直方图，单位为秒，最后一个桶为超出最大边界的值
+class Histogram(object):
+    BOUNDS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+              0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, bounds=BOUNDS):
+        self.bounds = bounds
+        self.buckets = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.buckets[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    # 估算百分位数，返回该百分位所在桶的上边界，落在最后一个桶时返回最大值
+    def percentile(self, p):
+        if self.count == 0:
+            return 0.0
+        rank = p / 100.0 * self.count
+        seen = 0
+        for n, c in enumerate(self.buckets):
+            seen += c
+            if seen >= rank and c:
+                return min(self.bounds[n], self.max) if n < len(self.bounds) else self.max
+        return self.max
+
+    def snapshot(self):
+        return dict(
+            count=self.count,
+            sum=self.sum,
+            max=self.max,
+            mean=self.sum / self.count if self.count else 0.0,
+            p50=self.percentile(50),
+            p95=self.percentile(95),
+            p99=self.percentile(99),
+            buckets=list(zip(self.bounds + (None,), self.buckets))
+        )
+
+
+# 单条sql模板的统计
+class StatementStats(object):
+
+    def __init__(self, sql):
+        self.sql = sql
+        self.calls = 0
+        self.errors = 0
+        self.rows = 0
+        self.affected = 0
+        self.wait = Histogram()
+        self.time = Histogram()
+
+    def snapshot(self):
+        return dict(calls=self.calls, errors=self.errors, rows=self.rows, affected=self.affected,
+                    wait=self.wait.snapshot(), time=self.time.snapshot())
+
+
+# 隐藏参数的值，只保留类型，避免在日志中输出用户数据
+def redact(args):
+    return ['<%s>' % type(a).__name__ for a in (args or ())]
+
+
+# 按sql模板汇总统计信息，执行时间超过slow_threshold秒的语句写入慢查询日志
+class StatementRegistry(object):
+
+    def __init__(self, slow_threshold=0.5, max_statements=1024):
+        self.slow_threshold = slow_threshold
+        self.max_statements = max_statements
+        self._statements = dict()
+
+    # wait为等待连接的时间，elapsed为执行时间，rows为返回行数，affected为影响行数
+    def record(self, sql, wait, elapsed, rows=0, affected=0, args=None, error=False):
+        stats = self._statements.get(sql)
+        if stats is None:
+            if len(self._statements) >= self.max_statements:
+                sql = '<other>'
+                stats = self._statements.get(sql)
+            if stats is None:
+                stats = self._statements[sql] = StatementStats(sql)
+        stats.calls += 1
+        if error:
+            stats.errors += 1
+        stats.rows += rows
+        stats.affected += affected
+        stats.wait.observe(wait)
+        stats.time.observe(elapsed)
+        if self.slow_threshold is not None and elapsed >= self.slow_threshold:
+            slow_logger.warning('slow query: %.1f ms (pool wait %.1f ms), rows: %s, affected: %s, sql: %s, args: %s',
+                                elapsed * 1000, wait * 1000, rows, affected, sql, redact(args))
+
+    def snapshot(self):
+        return dict((sql, stats.snapshot()) for sql, stats in self._statements.items())
+
+    def reset(self):
+        self._statements.clear()
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+"""
+把blogs和comments的旧id（15位毫秒时间戳 + 32位uuid + 000）迁移为ids.py生成的13位id，
+新id由旧id中的时间戳生成，使用保留的worker 0，保持原有的先后顺序，重复执行时跳过已迁移的行。
+users的id不迁移：密码以uid加盐，修改id会导致无法登录。
+用法：在项目根目录执行 python -m db.migrate_ids，旧id到新id的对应关系输出到标准输出，可用于旧链接的重定向
+"""
+
+import asyncio
+import logging
+
+from db import ids, orm
+from www.config.config import configs
+
+
+# 按旧id中的时间戳生成新id，无法解析时使用created_at
+class Migrator(object):
+
+    def __init__(self):
+        self._sequences = dict()
+
+    def new_id(self, old, created_at):
+        if len(old) == 50 and old[:15].isdigit():
+            ms = int(old[:15])
+        else:
+            ms = int(created_at * 1000)
+        if ms < ids.EPOCH:
+            raise ValueError('id %s is older than ids.EPOCH' % old)
+        sequence = self._sequences.get(ms, 0)
+        if sequence > ids.MAX_SEQUENCE:
+            raise ValueError('too many ids in %s ms' % ms)
+        self._sequences[ms] = sequence + 1
+        return ids.make(ms, ids.MIGRATION_WORKER, sequence)
+
+
+async def migrate_table(migrator, table, references=()):
+    rows = await orm.select('select `id`, `created_at` from `%s` order by `created_at`, `id`' % table, [])
+    count = 0
+    for row in rows:
+        old = row['id']
+        if len(old) == ids.LENGTH:
+            continue
+        new = migrator.new_id(old, row['created_at'])
+        for ref_table, ref_column in references:
+            await orm.execute('update `%s` set `%s`=? where `%s`=?' % (ref_table, ref_column, ref_column), [new, old])
+        await orm.execute('update `%s` set `id`=? where `id`=?' % table, [new, old])
+        print('%s\t%s\t%s' % (table, old, new))
+        count += 1
+    logging.info('migrated %s ids in %s' % (count, table))
+
+
+async def migrate():
+    await orm.create_pool(None, **configs['db'])
+    migrator = Migrator()
+    async with orm.transaction():
+        await migrate_table(migrator, 'blogs', references=[('comments', 'blog_id')])
+        await migrate_table(migrator, 'comments')
+    # 修改列类型会隐式提交，放在事务之外
+    await orm.execute('alter table `blogs` modify `id` char(13) not null', [])
+    await orm.execute('alter table `comments` modify `id` char(13) not null, modify `blog_id` char(13) not null', [])
+
+
+if __name__ == '__main__':
+    asyncio.run(migrate())
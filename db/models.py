@@ -1,46 +1,63 @@
 # -*- coding: utf-8 -*-
 import time
-import uuid
 
-from .orm import Model, StringField, BooleanField, FloatField, TextField
-
-
-def next_id():
-    return '%015d%s000' % (int(time.time() * 1000), uuid.uuid4().hex)
+from .ids import next_id
+from .orm import Model, StringField, BooleanField, FloatField, TextField, execute, transaction
 
 
 class User(Model):
     __table__ = 'users'
 
-    id = StringField(primary_key=True, default=next_id(), ddl='varchar(50)')
-    email = StringField(ddl='varchar(50)')
+    # 旧用户的密码以uid加盐，迁移时保留原有的50位id
+    id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
+    # 登录和注册按email查询
+    email = StringField(ddl='varchar(50)', unique=True)
     passwd = StringField(ddl='varchar(50)')
     admin = BooleanField()
     name = StringField(ddl='varchar(50)')
     image = StringField(ddl='varchar(500)')
-    created_at = FloatField(default=time.time)
+    created_at = FloatField(default=time.time, index=True)
+    # 会话版本号不在映射中，只有使用签名token登录时users表才有session_version列，
+    # 为True时表示该列存在，由web层按session.format设置
+    __session_version__ = False
+
+    # 修改密码或管理员权限时先增加会话版本号，使该用户已签发的登录token失效
+    async def update(self):
+        if not self.__session_version__:
+            return await super(User, self).update()
+        self._check_complete('update')
+        async with transaction():
+            await execute('update `users` set `session_version`=`session_version`+1 '
+                          'where `id`=? and (`passwd`<>? or `admin`<>?)', [self.id, self.passwd, self.admin])
+            return await super(User, self).update()
 
 
 class Blog(Model):
     __table__ = 'blogs'
+    # 博客很少修改，首页和博客页的查询结果缓存10秒，写入时自动失效
+    __cache_ttl__ = 10
+    # 列表页只需要摘要信息，不读取正文
+    __projections__ = dict(card=('id', 'user_id', 'user_name', 'user_image', 'name', 'summary', 'created_at'))
 
-    id = StringField(primary_key=True, default=next_id(), ddl='varchar(50)')
+    id = StringField(primary_key=True, default=next_id, ddl='char(13)')
     user_id = StringField(ddl='varchar(50)')
     user_name = StringField(ddl='varchar(50)')
     user_image = StringField(ddl='varchar(500)')
     name = StringField(ddl='varchar(50)')
     summary = StringField(ddl='varchar(200)')
     content = TextField()
-    created_at = FloatField(default=time.time)
+    created_at = FloatField(default=time.time, index=True)
 
 
 class Comment(Model):
     __table__ = 'comments'
+    # 博客页按blog_id查询评论并按created_at排序
+    __indexes__ = (('blog_id', 'created_at'),)
 
-    id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
-    blog_id = StringField(ddl='varchar(50)')
+    id = StringField(primary_key=True, default=next_id, ddl='char(13)')
+    blog_id = StringField(ddl='char(13)')
     user_id = StringField(ddl='varchar(50)')
     user_name = StringField(ddl='varchar(50)')
     user_image = StringField(ddl='varchar(500)')
     content = TextField()
-    created_at = FloatField(default=time.time)
+    created_at = FloatField(default=time.time, index=True)
@@ -5,21 +5,262 @@
 """
 
 import asyncio
+import atexit
+import collections
+import contextvars
+import itertools
 import logging
+import time
 logging.basicConfig(level=logging.INFO)
 import aiomysql
+import re
+import sys
 
+from .cache import ResultCache
+from .explain import PlanAuditor, caller as explain_caller, origin as explain_origin
+from .metrics import Histogram, StatementRegistry
 
+
+# 只在启用INFO级别时格式化sql
 def log(sql, args=()):
-    logging.info('SQL: %s' % sql)
+    logging.info('SQL: %s', sql)
 
 
-# 创建一个连接池
-@asyncio.coroutine
-def create_pool(loop, **kw):
-    logging.info('creating database connection pool...')
-    global __pool
-    __pool = yield from aiomysql.create_pool(
+# 已编译为%s占位符的sql语句，select和execute遇到该类型时不再重复转换
+class _Compiled(str):
+    pass
+
+
+# 编译缓存，key为带?占位符的sql，value为_Compiled
+_compiled = dict()
+_COMPILED_MAX = 1024
+
+
+# 将sql中的?占位符替换为%s，并把%转义为%%，引号内的字面量?保持不变
+def _translate(sql):
+    L = []
+    quote = None
+    escaped = False
+    for ch in sql:
+        if quote:
+            if escaped:
+                escaped = False
+            elif ch == '\\':
+                escaped = True
+            elif ch == quote:
+                quote = None
+        elif ch in '\'"`':
+            quote = ch
+        elif ch == '?':
+            L.append('%s')
+            continue
+        L.append('%%' if ch == '%' else ch)
+    return ''.join(L)
+
+
+# 返回编译后的sql，相同的sql只转换一次
+def compile_sql(sql):
+    if isinstance(sql, _Compiled):
+        return sql
+    compiled = _compiled.get(sql)
+    if compiled is None:
+        compiled = _Compiled(_translate(sql))
+        if len(_compiled) < _COMPILED_MAX:
+            _compiled[sql] = compiled
+    return compiled
+
+
+# 获取连接超时，web层返回503
+class PoolTimeoutError(Exception):
+    pass
+
+
+# 连接池句柄，在aiomysql的连接池前限制同时使用的连接数（limit，在minsize和maxsize之间），
+# 记录使用中、空闲、等待的连接数和等待时间，
+# outstanding为已申请但未归还的连接数（含等待中），用于最少未完成请求的负载均衡
+class _PoolHandle(object):
+
+    def __init__(self, name, pool, minsize=1, maxsize=10, timeout=None):
+        self.name = name
+        self.pool = pool
+        self.minsize = minsize
+        self.maxsize = maxsize
+        self.limit = maxsize
+        self.timeout = timeout
+        self.outstanding = 0
+        self.in_use = 0
+        self.acquired = 0
+        self.timeouts = 0
+        # 上次采样以来的最大等待数，供PoolController使用
+        self.peak_waiters = 0
+        self.wait = Histogram()
+        self._waiters = collections.deque()
+
+    # timeout为请求剩余的时间，与acquire_timeout取较小值；
+    # 请求的截止时间先到时抛出QueryTimeoutError（504），不计入timeouts
+    async def acquire(self, timeout=None):
+        deadline = timeout is not None and (self.timeout is None or timeout <= self.timeout)
+        if not deadline:
+            timeout = self.timeout
+        self.outstanding += 1
+        start = time.monotonic()
+        try:
+            await self._acquire_slot(timeout)
+            try:
+                remaining = None if timeout is None else max(timeout - (time.monotonic() - start), 0)
+                conn = await asyncio.wait_for(self.pool.acquire(), remaining)
+            except BaseException:
+                self._release_slot()
+                raise
+        except asyncio.TimeoutError:
+            self.outstanding -= 1
+            if deadline:
+                raise QueryTimeoutError('deadline exceeded while waiting for a connection from %s pool' % self.name)
+            self.timeouts += 1
+            raise PoolTimeoutError('timeout acquiring connection from %s pool after %.3f s' % (self.name, timeout))
+        except BaseException:
+            self.outstanding -= 1
+            raise
+        self.acquired += 1
+        self.wait.observe(time.monotonic() - start)
+        return conn
+
+    # 使用中的连接数达到limit时排队等待，归还时按顺序把名额交给等待者
+    async def _acquire_slot(self, timeout):
+        if self.in_use < self.limit and not self._waiters:
+            self.in_use += 1
+            return
+        future = asyncio.get_event_loop().create_future()
+        self._waiters.append(future)
+        self.peak_waiters = max(self.peak_waiters, len(self._waiters))
+        try:
+            await asyncio.wait_for(future, timeout)
+        except BaseException:
+            # 名额已交给自己但等待方超时或被取消时，把名额交还
+            if future.done() and not future.cancelled():
+                self._release_slot()
+            raise
+        finally:
+            if future in self._waiters:
+                self._waiters.remove(future)
+
+    def _release_slot(self):
+        if self.in_use <= self.limit:
+            while self._waiters:
+                future = self._waiters.popleft()
+                if not future.done():
+                    future.set_result(None)
+                    return
+        self.in_use -= 1
+
+    def release(self, conn):
+        self.outstanding -= 1
+        self._release_slot()
+        self.pool.release(conn)
+
+    # 调整limit，增大时唤醒等待者
+    def resize(self, limit):
+        limit = max(self.minsize, min(self.maxsize, limit))
+        if limit != self.limit:
+            logging.info('resize %s pool: %s => %s' % (self.name, self.limit, limit))
+        self.limit = limit
+        while self.in_use < self.limit and self._waiters:
+            future = self._waiters.popleft()
+            if not future.done():
+                self.in_use += 1
+                future.set_result(None)
+
+    def stats(self):
+        return dict(
+            limit=self.limit,
+            minsize=self.minsize,
+            maxsize=self.maxsize,
+            size=self.pool.size,
+            in_use=self.in_use,
+            idle=self.pool.freesize,
+            waiters=len(self._waiters),
+            outstanding=self.outstanding,
+            acquired=self.acquired,
+            timeouts=self.timeouts,
+            wait=self.wait.snapshot()
+        )
+
+
+# 根据等待队列的长度调整连接池的limit：有等待时增大，连续idle_rounds次采样没有等待且使用率低于一半时减小，
+# 减小时关闭多余的空闲连接
+class PoolController(object):
+
+    def __init__(self, handle, interval=1.0, step=2, idle_rounds=10):
+        self.handle = handle
+        self.interval = interval
+        self.step = step
+        self.idle_rounds = idle_rounds
+        self._idle = 0
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.adjust()
+            except Exception as e:
+                logging.exception(e)
+
+    async def adjust(self):
+        h = self.handle
+        waiters, h.peak_waiters = h.peak_waiters, len(h._waiters)
+        if waiters > 0:
+            self._idle = 0
+            h.resize(h.limit + max(self.step, waiters))
+            return
+        if h.in_use * 2 >= h.limit:
+            self._idle = 0
+            return
+        self._idle += 1
+        if self._idle < self.idle_rounds:
+            return
+        self._idle = 0
+        h.resize(h.limit - 1)
+        # 关闭超出limit的空闲连接，连接池会丢弃已关闭的连接
+        while h.pool.freesize > 0 and h.pool.size > h.limit:
+            conn = await h.pool.acquire()
+            conn.close()
+            h.pool.release(conn)
+
+
+# 连接的上下文管理器，退出时归还连接
+class _Connection(object):
+    def __init__(self, handle, conn):
+        self.handle = handle
+        self._conn = conn
+
+    def __enter__(self):
+        return self._conn
+
+    def __exit__(self, *args):
+        self.handle.release(self._conn)
+
+
+__pool = None
+__replicas = []
+__controllers = []
+# 写操作后，当前上下文的读操作在sticky秒内仍然走主库，保证读到自己的写入
+_sticky = 1.0
+_last_write = contextvars.ContextVar('orm_last_write', default=0.0)
+_rotation = itertools.count()
+
+
+async def _create_pool(name, loop, kw, defaults):
+    # 副本配置中未给出的项沿用主库配置
+    kw = dict(defaults, **kw)
+    pool = await aiomysql.create_pool(
         host=kw.get('host', 'localhost'),
         # 注意port是int类型，不是str
         port=kw.get('port', 3306),
@@ -32,49 +273,757 @@ def create_pool(loop, **kw):
         minsize=kw.get('minsize', 1),
         loop=loop
     )
+    handle = _PoolHandle(name, pool, kw.get('minsize', 1), kw.get('maxsize', 10), kw.get('acquire_timeout'))
+    # adaptive为True时，limit从minsize开始，由PoolController根据等待情况在minsize和maxsize之间调整
+    if kw.get('adaptive'):
+        handle.resize(handle.minsize)
+        controller = PoolController(handle, kw.get('adaptive_interval', 1.0))
+        controller.start()
+        __controllers.append(controller)
+    return handle
 
 
-# 定义select操作，传入ModelMetaclass根据Model类组织的sql语句
-@asyncio.coroutine
-def select(sql, args, size=None):
-    log(sql, args)
-    global __pool
-    with (yield from __pool) as conn:
-        # 从连接池获取一个cursor
-        cur = yield from conn.cursor(aiomysql.DictCursor)
-        # 将sql语句中的?替换为%s，并加入args参数
-        yield from cur.execute(sql.replace('?', '%s'), args or ())
-        # 是否有结果条数的要求
-        if size:
-            rs = yield from cur.fetchmany(size)
+# 创建一个连接池，minsize和maxsize为连接数的范围，acquire_timeout为获取连接的超时时间（秒，None为一直等待），
+# 超时抛出PoolTimeoutError，adaptive为True时根据等待情况自动调整连接数，
+# slow_query为慢查询的阈值（秒，None为不记录），deadline_hint为False时不在select中加入MAX_EXECUTION_TIME提示，
+# replicas为只读副本的配置列表，每项为与主库相同格式的dict，
+# 例如本地测试时可以用不同端口的替身服务器：replicas=[dict(port=3307), dict(port=3308)]
+async def create_pool(loop, **kw):
+    logging.info('creating database connection pool...')
+    global __pool, __replicas, _sticky
+    replicas = kw.pop('replicas', None) or []
+    _sticky = kw.pop('sticky', _sticky)
+    _statements.slow_threshold = kw.pop('slow_query', _statements.slow_threshold)
+    global _deadline_hint
+    _deadline_hint = kw.pop('deadline_hint', _deadline_hint)
+    for controller in __controllers:
+        controller.stop()
+    del __controllers[:]
+    __pool = await _create_pool('primary', loop, kw, {})
+    handles = []
+    for n, replica in enumerate(replicas):
+        logging.info('creating replica connection pool %s...' % n)
+        handles.append(await _create_pool('replica-%s' % n, loop, replica, kw))
+    __replicas = handles
+
+
+# 返回各连接池的统计：limit、使用中、空闲、等待的连接数，获取连接的次数、超时次数和等待时间分布
+def pool_stats():
+    if __pool is None:
+        return dict()
+    return dict((h.name, h.stats()) for h in [__pool] + __replicas)
+
+
+# 选择执行读操作的连接池：最近写过的上下文走主库，否则选择未完成请求最少的副本，
+# 未完成请求数相同时轮流选择
+def _route_read():
+    if not __replicas or time.time() - _last_write.get() < _sticky:
+        return __pool
+    start = next(_rotation) % len(__replicas)
+    return min(__replicas[start:] + __replicas[:start], key=lambda h: h.outstanding)
+
+
+# 当前上下文中的事务，Transaction会记录所属的task，只有该task内的语句使用事务连接
+_transaction = contextvars.ContextVar('orm_transaction', default=None)
+
+
+def _current_transaction():
+    tx = _transaction.get()
+    if tx is not None and tx.task is asyncio.current_task():
+        return tx
+    return None
+
+
+# 事务连接的上下文管理器，退出时不归还连接，由Transaction负责归还
+class _Pinned(object):
+    def __init__(self, conn, handle):
+        self.handle = handle
+        self._conn = conn
+
+    def __enter__(self):
+        return self._conn
+
+    def __exit__(self, *args):
+        pass
+
+
+# 获取一个连接，若当前task处于事务中，返回事务绑定的连接，
+# readonly为True时可路由到只读副本，否则使用主库并记录写入时间，
+# 等待连接的时间不超过当前请求剩余的时间
+async def _connect(readonly=False):
+    tx = _current_transaction()
+    if tx is not None:
+        return _Pinned(tx.conn, __pool)
+    if readonly:
+        handle = _route_read()
+    else:
+        handle = __pool
+        _last_write.set(time.time())
+    return _Connection(handle, await handle.acquire(_remaining()))
+
+
+async def _acquire():
+    _last_write.set(time.time())
+    return await __pool.acquire(_remaining())
+
+
+def _release(conn):
+    __pool.release(conn)
+
+
+# 事务作用域，在一个连接上开启事务并绑定到当前task，期间Model的读写自动使用该连接，
+# 用法：async with orm.transaction() as tx: ...，
+# 或tx = await orm.transaction().begin()，再调用tx.commit()/tx.rollback()。
+# 在事务内再次开启事务时加入外层事务，由外层负责提交
+class Transaction(object):
+
+    def __init__(self):
+        self.conn = None
+        self.task = None
+        # 事务中写入过的表，结束时使其缓存失效
+        self.tables = set()
+        # 事务中的写入通知，提交后再调用监听函数，避免其他连接在提交前读到旧的数据并重新缓存
+        self.writes = []
+        self._token = None
+        self._outer = None
+
+    async def begin(self):
+        self._outer = _current_transaction()
+        if self._outer is not None:
+            self.conn = self._outer.conn
+            self.task = self._outer.task
+            return self
+        self.conn = await _acquire()
+        try:
+            await self.conn.begin()
+        except BaseException:
+            _release(self.conn)
+            raise
+        self.task = asyncio.current_task()
+        self._token = _transaction.set(self)
+        return self
+
+    async def _finish(self, commit):
+        if self._outer is not None or self._token is None:
+            return
+        try:
+            if commit:
+                await self.conn.commit()
+            elif not self.conn.closed:
+                # 语句因超时被中止时连接已关闭，服务器会回滚未提交的事务
+                await self.conn.rollback()
+        finally:
+            _transaction.reset(self._token)
+            self._token = None
+            _release(self.conn)
+            if _cache is not None:
+                for table in self.tables:
+                    _cache.invalidate(table)
+            # 回滚时数据没有变化，不需要通知
+            if commit:
+                for model, key in self.writes:
+                    notify_write(model, key)
+
+    async def commit(self):
+        await self._finish(True)
+
+    async def rollback(self):
+        await self._finish(False)
+
+    async def __aenter__(self):
+        return await self.begin()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            await self.commit()
+        else:
+            await self.rollback()
+
+
+def transaction():
+    return Transaction()
+
+
+# 请求作用域，包含identity map和按主键批量加载的loader，由web层在每个请求开始时进入
+_scope = contextvars.ContextVar('orm_scope', default=None)
+# 一条where in查询最多包含的主键数
+_IN_MAX = 500
+
+
+# 按主键合并加载：同一事件循环tick内对同一Model的多次find(pk)合并为一次where in查询
+class _Loader(object):
+
+    def __init__(self, model):
+        self._model = model
+        self._pending = dict()
+        # 开启EXPLAIN审计时，本批第一个调用方的(Model方法, handler)
+        self._origin = None
+
+    def load(self, pk):
+        future = self._pending.get(pk)
+        if future is None:
+            loop = asyncio.get_event_loop()
+            if not self._pending:
+                loop.call_soon(self._dispatch)
+                if _auditor is not None:
+                    # 查询在另一个task中执行，在这里记录发起查询的调用方
+                    self._origin = explain_caller(sys._getframe(1))
+            future = self._pending[pk] = loop.create_future()
+        return future
+
+    def _dispatch(self):
+        pending, self._pending = self._pending, dict()
+        origin, self._origin = self._origin, None
+        asyncio.ensure_future(self._load(pending, origin))
+
+    async def _load(self, pending, origin=None):
+        if origin is not None:
+            explain_origin.set(origin)
+        try:
+            models = await self._model.find_many(list(pending.keys()))
+        except BaseException as e:
+            for future in pending.values():
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for future, m in zip(pending.values(), models):
+            if not future.done():
+                future.set_result(m)
+
+
+# 请求作用域，用法：with orm.scope(): ...，
+# identity map保存{Model类: {主键: 实例或None}}，作用域内重复查询同一主键直接返回内存中的实例
+class Scope(object):
+
+    def __init__(self):
+        self.identity = dict()
+        self._loaders = dict()
+        self._token = None
+
+    def loader(self, model):
+        loader = self._loaders.get(model)
+        if loader is None:
+            loader = self._loaders[model] = _Loader(model)
+        return loader
+
+    # 写操作后更新identity map，instance为None时丢弃该Model的所有实例
+    def written(self, model, instance=None, removed=False):
+        if instance is None:
+            self.identity.pop(model, None)
         else:
-            rs = yield from cur.fetchall()
-        yield from cur.close()
-        return rs
+            self.identity.setdefault(model, dict())[instance.getValue(model.__primary_key__)] = None if removed else instance
+
+    def __enter__(self):
+        self._token = _scope.set(self)
+        return self
+
+    def __exit__(self, *args):
+        _scope.reset(self._token)
+        self._token = None
+
+
+def scope():
+    return Scope()
+
+
+# 写入的监听函数，参数为Model和主键的值，无法确定写入的行时主键为None
+_write_listeners = []
+
+
+# 注册监听函数，在本进程通过Model写入之后调用（事务中为提交之后），用于维护其他缓存
+def add_write_listener(listener):
+    _write_listeners.append(listener)
+
+
+def _written(model, instance=None, removed=False):
+    # 部分Model只会被删除，记录到完整的Model上
+    if model.__partial__ is not None:
+        model = model.__bases__[0]
+    s = _scope.get()
+    if s is not None:
+        s.written(model, instance, removed)
+    if _write_listeners:
+        notify_write(model, None if instance is None else instance.getValue(model.__primary_key__))
+
+
+# 通知监听函数model的一行（key为None时为任意行）已被修改，不经过Model写入时需要手动调用，
+# 处于事务中时在提交之后通知
+def notify_write(model, key=None):
+    tx = _current_transaction()
+    if tx is not None:
+        tx.writes.append((model, key))
+        return
+    for listener in _write_listeners:
+        listener(model, key)
+
+
+# 查询结果缓存，enable_cache之后，对__cache_ttl__大于0的Model的查询结果生效
+_cache = None
+# 写语句 => 写入的表名，无法识别时为None
+_write_tables = dict()
+_RE_WRITE_TABLE = re.compile(r'^\s*(?:insert\s+(?:ignore\s+)?into|replace\s+into|update|delete\s+from)\s+`?(\w+)`?', re.I)
+
+
+def enable_cache(max_bytes=16 * 1024 * 1024):
+    global _cache
+    logging.info('enable query result cache, max bytes: %s' % max_bytes)
+    _cache = ResultCache(max_bytes)
+
+
+def cache_stats():
+    return _cache.stats() if _cache is not None else None
+
+
+# 写语句执行后使其写入的表的缓存失效，无法识别表名时清空缓存，
+# 事务中的写入在提交或回滚时再次失效，避免其他请求在提交前缓存了旧的结果
+def _invalidate(sql):
+    if _cache is None:
+        return
+    try:
+        table = _write_tables[sql]
+    except KeyError:
+        m = _RE_WRITE_TABLE.match(sql)
+        table = m.group(1) if m else None
+        if len(_write_tables) < _COMPILED_MAX:
+            _write_tables[sql] = table
+    _cache.invalidate(table)
+    tx = _current_transaction()
+    if tx is not None:
+        tx.tables.add(table)
+
+
+# 查询超过请求的截止时间
+class QueryTimeoutError(Exception):
+    pass
+
+
+# 当前请求的截止时间（time.monotonic()），由web层按路由设置
+_deadline = contextvars.ContextVar('orm_deadline', default=None)
+# 为True时在select语句中加入MAX_EXECUTION_TIME提示，由MySQL在超时后中止查询，连接保持可用
+_deadline_hint = True
+# 客户端在截止时间之后再等待的时间，超时后通过KILL QUERY中止查询
+_DEADLINE_GRACE = 0.05
+# KILL QUERY之后等待服务器返回中止错误的时间，超时则关闭连接
+_KILL_WAIT = 1.0
+# 查询被中止的错误码：KILL QUERY，MySQL的MAX_EXECUTION_TIME和MariaDB的max_statement_time
+_QUERY_TIMEOUT_ERRORS = (1317, 3024, 1969)
+
+
+# 截止时间作用域，用法：with orm.deadline(2.0): ...，timeout为None时不限制，
+# 嵌套时取较早的截止时间
+class Deadline(object):
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self._token = None
+
+    def __enter__(self):
+        at = None if self.timeout is None else time.monotonic() + self.timeout
+        outer = _deadline.get()
+        if outer is not None and (at is None or outer < at):
+            at = outer
+        self._token = _deadline.set(at)
+        return self
+
+    def __exit__(self, *args):
+        _deadline.reset(self._token)
+
+
+def deadline(timeout):
+    return Deadline(timeout)
+
+
+# 返回当前请求剩余的秒数，没有截止时间时返回None，已超时抛出QueryTimeoutError
+def _remaining():
+    at = _deadline.get()
+    if at is None:
+        return None
+    remaining = at - time.monotonic()
+    if remaining <= 0:
+        raise QueryTimeoutError('deadline exceeded')
+    return remaining
+
+
+# 在select语句中加入MAX_EXECUTION_TIME提示
+def _hinted(sql, remaining):
+    if not _deadline_hint or remaining is None or not sql[:6].lower() == 'select':
+        return sql
+    return _Compiled('%s /*+ MAX_EXECUTION_TIME(%d) */%s' % (sql[:6], max(int(remaining * 1000), 1), sql[6:]))
+
+
+# 通过另一个连接中止conn上正在执行的语句
+async def _kill(handle, conn):
+    try:
+        side = await asyncio.wait_for(handle.pool.acquire(), _KILL_WAIT)
+        try:
+            cur = await side.cursor()
+            await cur.execute('KILL QUERY %d' % conn.thread_id())
+            await cur.close()
+        finally:
+            handle.pool.release(side)
+        logging.warning('killed query on connection %s' % conn.thread_id())
+    except Exception as e:
+        logging.warning('failed to kill query: %s' % e)
+
+
+# 在截止时间内执行coro（只包含驱动的读写）。超时或请求被取消（例如客户端断开）时，
+# 在另一个连接上KILL QUERY，并等待服务器返回中止错误，这样连接上没有未读完的结果，可以直接放回连接池；
+# 服务器没有及时响应时才关闭连接，由连接池丢弃
+async def _bounded(handle, conn, coro):
+    at = _deadline.get()
+    if at is None:
+        return await _interrupted(coro)
+    task = asyncio.ensure_future(_interrupted(coro))
+    try:
+        await asyncio.wait([task], timeout=max(at - time.monotonic(), 0) + _DEADLINE_GRACE)
+    except asyncio.CancelledError:
+        await asyncio.shield(_abort(handle, conn, task))
+        raise
+    if not task.done():
+        await asyncio.shield(_abort(handle, conn, task))
+        if task.cancelled():
+            raise QueryTimeoutError('query cancelled after deadline')
+    return task.result()
+
+
+async def _abort(handle, conn, task):
+    await _kill(handle, conn)
+    await asyncio.wait([task], timeout=_KILL_WAIT)
+    if not task.done():
+        task.cancel()
+        conn.close()
+    elif not task.cancelled():
+        task.exception()
+
+
+# 把服务器中止查询的错误转换为QueryTimeoutError
+async def _interrupted(coro):
+    try:
+        return await coro
+    except aiomysql.Error as e:
+        if e.args and e.args[0] in _QUERY_TIMEOUT_ERRORS:
+            raise QueryTimeoutError('query interrupted after deadline: %s' % e.args[1])
+        raise
+
+
+# 按sql模板汇总的耗时统计，执行时间超过slow_query秒的语句写入orm.slow日志
+_statements = StatementRegistry()
+
+
+# 返回按sql模板汇总的统计：调用次数、错误数、返回行数、影响行数，以及等待连接和执行时间的直方图
+def statement_stats():
+    return _statements.snapshot()
+
+
+def reset_statement_stats():
+    _statements.reset()
+
+
+# 正在执行的select，key为(sql, 参数, size, tuples, 是否必须读主库)，value为(结果的future, 开始时间)
+_inflight = dict()
+# issued为实际执行的select数，collapsed为等待相同查询结果而未执行的select数
+_flight_stats = dict(issued=0, collapsed=0)
 
 
-# Insert, Update, Delete操作，相同的参数
-@asyncio.coroutine
-def execute(sql, args, autocommit=True):
+def singleflight_stats():
+    return dict(_flight_stats, inflight=len(_inflight))
+
+
+# 开发模式下的EXPLAIN审计，见explain.py
+_auditor = None
+
+
+# 开启EXPLAIN审计，退出时输出报告，report为报告文件的路径
+def enable_explain(report=None):
+    global _auditor
+    _auditor = PlanAuditor(_explain, report)
+    atexit.register(_auditor.report)
+
+
+def explain_report():
+    return _auditor.snapshot() if _auditor is not None else {}
+
+
+# 在只读连接上执行EXPLAIN，不经过缓存和统计
+async def _explain(sql, args):
+    handle = _route_read()
+    conn = await handle.acquire()
+    try:
+        cur = await conn.cursor(aiomysql.DictCursor)
+        await cur.execute('explain ' + sql, args or ())
+        rows = await cur.fetchall()
+        await cur.close()
+    finally:
+        handle.release(conn)
+    return rows
+
+
+# 定义select操作，传入ModelMetaclass根据Model类组织的sql语句，
+# tuples为True时每行返回tuple，而不是dict，
+# model为查询的Model类，其__cache_ttl__大于0且启用了缓存时，结果在ttl秒内缓存，
+# 相同的查询正在执行时，等待其结果而不是再次查询，事务中的查询不使用缓存也不合并
+async def select(sql, args, size=None, tuples=False, model=None):
+    sql = compile_sql(sql)
+    if _auditor is not None:
+        _auditor.observe(sql, args)
+    if _current_transaction() is not None:
+        return await _select(sql, args, size, tuples)
+    try:
+        key = (sql, tuple(args or ()), size, tuples)
+        hash(key)
+    except TypeError:
+        # 参数不可hash时不缓存也不合并
+        return await _select(sql, args, size, tuples)
+    # 最近写过的上下文不读也不写缓存，保证读到自己的写入
+    last_write = _last_write.get()
+    now = time.time()
+    sticky = now - last_write < _sticky
+    cached = not sticky and _cache is not None and model is not None and model.__cache_ttl__
+    if cached:
+        rs = _cache.get(key)
+        if rs is not None:
+            return list(rs)
+        generation = _cache.generation(model.__table__)
+    # 最近写过的上下文需要读主库，不能使用读副本的查询结果
+    flight = key + (bool(__replicas) and sticky,)
+    entry = _inflight.get(flight)
+    if entry is not None:
+        future, started = entry
+        # 在自己写入之前开始的查询可能读不到写入的结果，不能加入
+        if started <= last_write:
+            return await _select(sql, args, size, tuples)
+        _flight_stats['collapsed'] += 1
+        try:
+            # shield保证等待方被取消时不影响正在执行的查询，等待时间不超过自己的截止时间
+            return list(await asyncio.wait_for(asyncio.shield(future), _remaining()))
+        except asyncio.TimeoutError:
+            raise QueryTimeoutError('deadline exceeded while waiting for an identical query')
+        except asyncio.CancelledError:
+            # 执行查询的一方被取消时自己查询
+            if not future.cancelled():
+                raise
+            return await _select(sql, args, size, tuples)
+        except QueryTimeoutError:
+            # 执行查询的一方的截止时间更早，按自己的截止时间重新查询
+            return await _select(sql, args, size, tuples)
+    future = asyncio.get_event_loop().create_future()
+    entry = _inflight[flight] = (future, now)
+    try:
+        rs = await _select(sql, args, size, tuples)
+    except asyncio.CancelledError:
+        future.cancel()
+        raise
+    except BaseException as e:
+        future.set_exception(e)
+        # 标记异常已被获取，没有等待方时不会输出警告
+        future.exception()
+        raise
+    else:
+        future.set_result(tuple(rs))
+        if cached:
+            _cache.put(key, model.__table__, model.__cache_ttl__, tuple(rs), generation)
+    finally:
+        if _inflight.get(flight) is entry:
+            del _inflight[flight]
+    return rs
+
+
+async def _select(sql, args, size, tuples):
+    log(sql, args)
+    _flight_stats['issued'] += 1
+    start = time.monotonic()
+    cm = await _connect(readonly=True)
+    acquired = time.monotonic()
+    rs = ()
+    error = True
+    try:
+        with cm as conn:
+            rs = await _bounded(cm.handle, conn, _fetch(conn, _hinted(sql, _remaining()), args, size, tuples))
+        error = False
+    finally:
+        _statements.record(sql, acquired - start, time.monotonic() - acquired, len(rs), 0, args, error)
+    return rs
+
+
+async def _fetch(conn, sql, args, size, tuples):
+    # 从连接池获取一个cursor
+    cur = await conn.cursor(aiomysql.Cursor if tuples else aiomysql.DictCursor)
+    # 将sql语句中的?替换为%s，并加入args参数
+    await cur.execute(sql, args or ())
+    # 是否有结果条数的要求
+    if size:
+        rs = await cur.fetchmany(size)
+    else:
+        rs = await cur.fetchall()
+    await cur.close()
+    return rs
+
+
+# 在给定连接上执行一条Insert, Update, Delete语句，返回结果数，wait为等待连接的时间，
+# handle为连接所属的连接池，超过截止时间时用于中止语句
+async def _execute_on(conn, sql, args, wait=0.0, handle=None):
+    sql = compile_sql(sql)
+    _remaining()
+    start = time.monotonic()
+    affected = 0
+    error = True
+    try:
+        try:
+            affected = await _bounded(handle or __pool, conn, _write(conn, sql, args))
+        finally:
+            _invalidate(sql)
+        error = False
+    finally:
+        _statements.record(sql, wait, time.monotonic() - start, 0, affected, args, error)
+    return affected
+
+
+async def _write(conn, sql, args):
+    cur = await conn.cursor()
+    await cur.execute(sql, args or ())
+    affected = cur.rowcount
+    await cur.close()
+    return affected
+
+
+# Insert, Update, Delete操作，相同的参数，处于事务中时加入当前事务
+async def execute(sql, args, autocommit=True):
     log(sql)
-    with (yield from __pool) as conn:
+    autocommit = autocommit or _current_transaction() is not None
+    start = time.monotonic()
+    cm = await _connect()
+    with cm as conn:
+        wait = time.monotonic() - start
         if not autocommit:
-            yield from conn.begin()
+            await conn.begin()
         try:
-            cur = yield from conn.cursor()
-            yield from cur.execute(sql.replace('?', '%s'), args)
             # 用于返回结果数
-            affected = cur.rowcount
-            yield from cur.close()
+            affected = await _execute_on(conn, sql, args, wait, cm.handle)
             if not autocommit:
-                yield from conn.commit()
+                await conn.commit()
         except BaseException:
-            if not autocommit:
-                yield from conn.rollback()
+            # 语句被中止时连接已关闭，不需要回滚
+            if not autocommit and not conn.closed:
+                await conn.rollback()
             raise
         return affected
 
 
+# 在同一个连接上依次执行多条语句，statements为(sql, args)的可迭代对象（可以是生成器），
+# autocommit为False时所有语句在一个事务内提交，返回每条语句的结果数
+async def execute_batch(statements, autocommit=True):
+    autocommit = autocommit or _current_transaction() is not None
+    start = time.monotonic()
+    cm = await _connect()
+    with cm as conn:
+        # 等待连接的时间计入第一条语句
+        wait = time.monotonic() - start
+        if not autocommit:
+            await conn.begin()
+        try:
+            rows = []
+            for sql, args in statements:
+                log(sql)
+                rows.append(await _execute_on(conn, sql, args, wait, cm.handle))
+                wait = 0.0
+            if not autocommit:
+                await conn.commit()
+        except BaseException:
+            # 语句被中止时连接已关闭，不需要回滚
+            if not autocommit and not conn.closed:
+                await conn.rollback()
+            raise
+        return rows
+
+
+# 流式查询的异步迭代器，使用服务端(unbuffered)游标每次取batch_size行，内存占用与结果集大小无关，
+# 用法：async with Model.iterate(...) as rows: async for m in rows: ...，
+# 迭代结束或提前退出async with时归还连接
+class RowIterator(object):
+
+    # make为由一行数据构造对象的函数，tuples为True时每行以tuple传入
+    def __init__(self, model, sql, args, batch_size, make=None, tuples=False):
+        self._model = model
+        self._make = make or (lambda r: model(**r))
+        self._tuples = tuples
+        self._sql = sql
+        self._args = args
+        self._batch_size = batch_size
+        self._cm = None
+        self._cur = None
+        self._rows = []
+        self._done = False
+        self._exhausted = False
+
+    async def _open(self):
+        log(self._sql, self._args)
+        self._cm = await _connect(readonly=True)
+        try:
+            conn = self._cm.__enter__()
+            self._cur = await conn.cursor(aiomysql.SSCursor if self._tuples else aiomysql.SSDictCursor)
+            await self._cur.execute(compile_sql(self._sql), self._args or ())
+        except BaseException:
+            await self.close()
+            raise
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self._rows:
+            if self._done:
+                raise StopAsyncIteration
+            if self._cm is None:
+                await self._open()
+            try:
+                rows = await self._cur.fetchmany(self._batch_size)
+            except BaseException:
+                await self.close()
+                raise
+            if len(rows) < self._batch_size:
+                # 结果集已读完，关闭cursor后正常归还连接
+                self._exhausted = True
+                await self.close()
+            self._rows = list(reversed(rows))
+            if not self._rows:
+                raise StopAsyncIteration
+        return self._make(self._rows.pop())
+
+    # 归还连接；若结果集未读完，关闭连接而不是读完剩余的行，连接池会丢弃已关闭的连接，
+    # 结果集已读完或处于事务中时关闭cursor，连接可以继续使用
+    async def close(self):
+        if self._done:
+            return
+        self._done = True
+        self._rows = []
+        cm, cur = self._cm, self._cur
+        self._cm = self._cur = None
+        if cm is None:
+            return
+        try:
+            if cur is not None:
+                if self._exhausted or isinstance(cm, _Pinned):
+                    await cur.close()
+                else:
+                    cm.__enter__().close()
+        finally:
+            cm.__exit__(None, None, None)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    def __del__(self):
+        if self._cm is not None and not self._done:
+            logging.warning('RowIterator for %s was not closed, dropping its connection.' % self._model.__name__)
+            self._done = True
+            if not isinstance(self._cm, _Pinned):
+                self._cm.__enter__().close()
+            self._cm.__exit__(None, None, None)
+
+
 # 用于返回__insert__语句的占位符
 def create_args_string(num):
     L = []
@@ -83,38 +1032,281 @@ def create_args_string(num):
     return ', '.join(L)
 
 
+# 查询形态缓存，key为(表名, 列, where, orderBy, limit形式)，value为编译后的sql
+_query_cache = dict()
+
+
+# 可链式调用的查询对象，where/order/limit/columns均返回新的Query，
+# 同一查询形态的sql只拼接和编译一次，之后每次请求只绑定参数
+class Query(object):
+
+    def __init__(self, model, columns=None, where=None, args=(), orderBy=None, limit=None, seek=None, compact=None):
+        self._model = model
+        # 紧凑模式返回Record而不是Model，默认取Model的__compact__
+        self._compact = model.__compact__ if compact is None else compact
+        self._columns = columns
+        self._where = where
+        self._args = tuple(args)
+        self._orderBy = orderBy
+        self._limit = limit
+        # keyset分页条件：(方向, 是否降序, 游标值)
+        self._seek = seek
+
+    def _replace(self, **kw):
+        params = dict(columns=self._columns, where=self._where, args=self._args,
+                      orderBy=self._orderBy, limit=self._limit, seek=self._seek, compact=self._compact)
+        params.update(kw)
+        return Query(self._model, **params)
+
+    def where(self, where, args=None):
+        return self._replace(where=where, args=args or ())
+
+    def order(self, orderBy):
+        return self._replace(orderBy=orderBy)
+
+    # limit(n)或limit(offset, n)，也接受(offset, n)形式的tuple
+    def limit(self, *limit):
+        if len(limit) == 1:
+            limit = limit[0]
+        if limit is None or isinstance(limit, int):
+            return self._replace(limit=limit)
+        if isinstance(limit, tuple) and len(limit) == 2:
+            return self._replace(limit=tuple(limit))
+        raise ValueError('Invalid limit value: %s' % str(limit))
+
+    # keyset分页，按Model的__keyset__列（默认为created_at和主键）排序，
+    # after取列表中位于游标之后的行，before取位于游标之前的行，
+    # 游标为__keyset__各列的值，无论第几页都只扫描limit行
+    def seek(self, after=None, before=None, desc=True):
+        if (after is None) == (before is None):
+            raise ValueError('Exactly one of after and before is required.')
+        direction, values = ('after', after) if after is not None else ('before', before)
+        values = tuple(values)
+        if len(values) != len(self._model.__keyset__):
+            raise ValueError('Invalid cursor for %s: %s' % (self._model.__name__, str(values)))
+        return self._replace(seek=(direction, desc, values))
+
+    # 只查询指定的列，返回的是不能保存的部分Model
+    def columns(self, *columns):
+        for c in columns:
+            if c not in self._model.__mappings__:
+                raise ValueError('Unknown column for %s: %s' % (self._model.__name__, c))
+        return self._replace(columns=tuple(columns) or None)
+
+    # 使用Model在__projections__中声明的列组合
+    def project(self, name):
+        try:
+            return self.columns(*self._model.__projections__[name])
+        except KeyError:
+            raise ValueError('Unknown projection for %s: %s' % (self._model.__name__, name))
+
+    # 紧凑模式，行以tuple读取，构造为只含查询列的Record
+    def compact(self, compact=True):
+        return self._replace(compact=compact)
+
+    # 查询结果的类型，指定了列时为对应的部分Model
+    def _row_class(self):
+        if self._columns is None:
+            return self._model
+        return self._model.partial(self._columns)
+
+    def shape(self, head=None):
+        limit = self._limit
+        if isinstance(limit, tuple):
+            limit = 2
+        elif limit is not None:
+            limit = 1
+        seek = self._seek[:2] if self._seek else None
+        return (self._model.__table__, head or self._columns, self._where, self._orderBy, limit, seek)
+
+    def _head(self):
+        if self._columns is None:
+            return self._model.__select__
+        return 'select %s from `%s`' % (', '.join('`%s`' % c for c in self._columns), self._model.__table__)
+
+    # 返回当前查询形态对应的已编译sql，head用于替换默认的select部分
+    def compile(self, head=None):
+        key = self.shape(head)
+        sql = _query_cache.get(key)
+        if sql is None:
+            L = [head or self._head()]
+            where = self._where
+            orderBy = self._orderBy
+            if self._seek and not head:
+                where, orderBy = self._seek_clause(where)
+            if where:
+                L.append('where')
+                L.append(where)
+            if orderBy:
+                L.append('order by')
+                L.append(orderBy)
+            if key[4] == 1:
+                L.append('limit ?')
+            elif key[4] == 2:
+                L.append('limit ?, ?')
+            sql = compile_sql(' '.join(L))
+            if len(_query_cache) < _COMPILED_MAX:
+                _query_cache[key] = sql
+        return sql
+
+    # 返回加上keyset条件后的where和orderBy，before方向按相反顺序查询，取回后再反转
+    def _seek_clause(self, where):
+        direction, desc, values = self._seek
+        forward = desc == (direction == 'after')
+        op = '<' if forward else '>'
+        keys = ['`%s`' % k for k in self._model.__keyset__]
+        cond = '%s %s ?' % (keys[-1], op)
+        for k in reversed(keys[:-1]):
+            cond = '(%s %s ? or (%s = ? and %s))' % (k, op, k, cond)
+        order = ', '.join('%s %s' % (k, 'desc' if forward else 'asc') for k in keys)
+        if where:
+            cond = '(%s) and %s' % (where, cond)
+        return cond, order
+
+    def _reversed(self):
+        return self._seek is not None and self._seek[0] == 'before'
+
+    def params(self):
+        args = list(self._args)
+        if self._seek:
+            values = self._seek[2]
+            for v in values[:-1]:
+                args.extend((v, v))
+            args.append(values[-1])
+        if isinstance(self._limit, tuple):
+            args.extend(self._limit)
+        elif self._limit is not None:
+            args.append(self._limit)
+        return args
+
+    async def all(self):
+        rs = await select(self.compile(), self.params(), tuples=True, model=self._model)
+        if self._reversed():
+            rs = reversed(rs)
+        if self._compact:
+            record = self._model.record(self._columns)
+            return [record(*r) for r in rs]
+        return list(map(self._row_class().__from_row__, rs))
+
+    async def first(self):
+        rs = await select(self.compile(), self.params(), 1, tuples=True, model=self._model)
+        if len(rs) == 0:
+            return None
+        if self._compact:
+            return self._model.record(self._columns)(*rs[0])
+        return self._row_class().__from_row__(rs[0])
+
+    # 流式读取查询结果，返回RowIterator
+    def iterate(self, batch_size=1000):
+        if self._compact:
+            record = self._model.record(self._columns)
+            return RowIterator(record, self.compile(), self.params(), batch_size, lambda r: record(*r), True)
+        cls = self._row_class()
+        return RowIterator(cls, self.compile(), self.params(), batch_size, cls.__from_row__, True)
+
+    # select count()等聚合查询，返回单个值，忽略排序、分页条件
+    async def number(self, selectField):
+        head = 'select %s _num_ from `%s`' % (selectField, self._model.__table__)
+        q = self._replace(orderBy=None, limit=None, seek=None)
+        rs = await select(q.compile(head), q.params(), 1, model=self._model)
+        if len(rs) == 0:
+            return None
+        return rs[0]['_num_']
+
+
+# 以下函数在定义Model时为其生成专用的代码，字段列表、默认值在生成时已确定，
+# 运行时不再逐个字段查找映射关系
+def _codegen(name, lines, namespace):
+    src = '\n'.join(lines)
+    logging.debug('generated %s:\n%s' % (name, src))
+    exec(compile(src, '<orm:%s>' % name, 'exec'), namespace)
+    return namespace[name]
+
+
+# 由tuple行构造Model，跳过__init__和**kw，直接写入dict
+def _gen_from_row(model, columns):
+    lines = ['def from_row(row):', '    m = _new(_model)']
+    if columns:
+        lines.append('    %s, = row' % ', '.join('m[%r]' % c for c in columns))
+    lines.append('    return m')
+    return _codegen('from_row', lines, dict(_new=dict.__new__, _model=model))
+
+
+# 返回__insert__的参数，未赋值的字段使用默认值，并写回实例
+def _gen_insert_args(mappings, columns):
+    namespace = dict()
+    lines = ['def _insert_args(self):', '    get = self.get']
+    for n, c in enumerate(columns):
+        lines.append('    v%d = get(%r)' % (n, c))
+        default = mappings[c].default
+        if default is not None:
+            namespace['_d%d' % n] = default
+            value = '_d%d()' % n if callable(default) else '_d%d' % n
+            lines.append('    if v%d is None:' % n)
+            lines.append('        v%d = self[%r] = %s' % (n, c, value))
+    lines.append('    return [%s]' % ', '.join('v%d' % n for n in range(len(columns))))
+    return _codegen('_insert_args', lines, namespace)
+
+
+# 返回__update__的参数
+def _gen_update_args(columns):
+    lines = ['def _update_args(self):', '    get = self.get',
+             '    return [%s]' % ', '.join('get(%r)' % c for c in columns)]
+    return _codegen('_update_args', lines, dict())
+
+
+# Record的位置参数构造函数
+def _gen_record_init(columns):
+    args = ', '.join('v%d' % n for n in range(len(columns)))
+    lines = ['def __init__(self%s):' % (', ' + args if args else '')]
+    lines.extend('    self.%s = v%d' % (c, n) for n, c in enumerate(columns))
+    lines.append('    pass')
+    return _codegen('__init__', lines, dict())
+
+
+# Record转换为JSON使用的dict
+def _gen_record_asdict(columns):
+    lines = ['def _asdict(self):',
+             '    return {%s}' % ', '.join('%r: self.%s' % (c, c) for c in columns)]
+    return _codegen('_asdict', lines, dict())
+
+
+# index为True时为该列建立索引，unique为True时建立唯一索引，见schema.py
 class Field(object):
 
-    def __init__(self, name, column_type, primary_key, default):
+    def __init__(self, name, column_type, primary_key, default, index=False, unique=False):
         self.name = name
         self.column_type = column_type
         self.primary_key = primary_key
         self.default = default
+        self.index = index
+        self.unique = unique
 
     def __str__(self):
         return '<%s, %s:%s>' % (self.__class__.__name__, self.column_type, self.name)
 
 
 class StringField(Field):
-    def __init__(self, name=None, primary_key=False, default=None, ddl='varchar(100)'):
-        super().__init__(name, ddl, primary_key, default)
+    def __init__(self, name=None, primary_key=False, default=None, ddl='varchar(100)', index=False, unique=False):
+        super().__init__(name, ddl, primary_key, default, index, unique)
 
 
 class BooleanField(Field):
-    def __init__(self, name=None, default=False):
-        super().__init__(name, 'boolean', False, default)
+    def __init__(self, name=None, default=False, index=False):
+        super().__init__(name, 'boolean', False, default, index)
 
 
 class IntegerField(Field):
-    def __init__(self, name=None, primary_key=False, default=0):
-        super().__init__(name, 'bigint', primary_key, default)
+    def __init__(self, name=None, primary_key=False, default=0, index=False, unique=False):
+        super().__init__(name, 'bigint', primary_key, default, index, unique)
 
 
 class FloatField(Field):
-    def __init__(self, name=None, primary_key=False, default=0.0):
-        super().__init__(name, 'real', primary_key, default)
+    def __init__(self, name=None, primary_key=False, default=0.0, index=False, unique=False):
+        super().__init__(name, 'real', primary_key, default, index, unique)
 
 
+# text列不能直接建立索引
 class TextField(Field):
     def __init__(self, name=None, default=None):
         super().__init__(name, 'text', False, default)
@@ -159,19 +1351,130 @@ class ModelMetaclass(type):
         attrs['__table__'] = tableName          # 保存表名
         attrs['__primary_key__'] = primaryKey   # 保存主键属性名
         attrs['__fields__'] = fields            # 保存除主键外的属性名
+        # 检查__projections__中声明的列组合
+        for projection, columns in attrs.get('__projections__', {}).items():
+            for c in columns:
+                if c not in mappings:
+                    raise RuntimeError('Unknown column in projection %s: %s' % (projection, c))
+        # 检查__indexes__和__unique__中声明的组合索引
+        for columns in attrs.get('__indexes__', ()) + attrs.get('__unique__', ()):
+            for c in columns:
+                if c not in mappings or isinstance(mappings[c], TextField):
+                    raise RuntimeError('Cannot index column in %s: %s' % (name, c))
+        # keyset分页使用的列，默认为(created_at, 主键)
+        if '__keyset__' not in attrs:
+            attrs['__keyset__'] = ('created_at', primaryKey) if 'created_at' in mappings else (primaryKey,)
         # 构造默认的增删改查语句
         attrs['__select__'] = 'select `%s`, %s from `%s`' % (primaryKey, ','.join(escaped_fields), tableName)
         attrs['__insert__'] = 'insert into `%s` (%s, `%s`) values (%s)' % (tableName, ','.join(escaped_fields), primaryKey, create_args_string(len(escaped_fields) + 1))
         attrs['__update__'] = 'update `%s` set %s where `%s`=?' % (tableName, ', '.join(map(lambda f: '`%s`=?' % (mappings.get(f).name or f), fields)), primaryKey)
         attrs['__delete__'] = 'delete from `%s` where `%s`=?' % (tableName, primaryKey)
-        return type.__new__(cls, name, bases, attrs)
+        attrs['__find__'] = compile_sql('%s where `%s`=?' % (attrs['__select__'], primaryKey))
+        # 生成该Model专用的参数构造函数
+        attrs['_insert_args'] = _gen_insert_args(mappings, fields + [primaryKey])
+        attrs['_update_args'] = _gen_update_args(fields + [primaryKey])
+        model = type.__new__(cls, name, bases, attrs)
+        # 由tuple行构造实例的函数，列顺序与__select__一致
+        model.__from_row__ = staticmethod(_gen_from_row(model, [primaryKey] + fields))
+        # 紧凑模式使用的Record类，属性顺序与__select__的列顺序一致
+        model.__record__ = _make_record(model, tuple([primaryKey] + fields))
+        return model
+
+
+# 紧凑的只读记录，由ModelMetaclass为每个Model生成子类，
+# 以__slots__保存查询的列，按列顺序以位置参数构造，属性直接访问，不再经过dict和__getattr__
+class Record(object):
+    __slots__ = ()
+    __model__ = None
+    __columns__ = ()
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def keys(self):
+        return list(self.__columns__)
+
+    def getValue(self, key):
+        return getattr(self, key, None)
+
+    def getKeyset(self):
+        return [self.getValue(k) for k in self.__model__.__keyset__]
+
+    # 转换为对应的Model，只包含部分列时为部分Model
+    def toModel(self):
+        if self.__columns__ == self.__model__.__record__.__columns__:
+            return self.__model__(**self._asdict())
+        return self.__model__.partial(self.__columns__)(**self._asdict())
+
+    def __eq__(self, other):
+        return isinstance(other, Record) and self._asdict() == other._asdict()
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__, ', '.join('%s=%r' % kv for kv in self._asdict().items()))
+
+
+# 生成Record子类，构造函数和转换为dict的_asdict()按列生成
+def _make_record(model, columns):
+    return type(model.__name__ + 'Record', (Record,), dict(
+        __slots__=columns, __model__=model, __columns__=columns, __module__=model.__module__,
+        __init__=_gen_record_init(columns), _asdict=_gen_record_asdict(columns)))
+
+
+# 部分Model类的缓存，key为(Model类, 列)
+_partial_classes = dict()
 
 
 # 这里可以看出，Model实际是一个字典类型
 class Model(dict, metaclass=ModelMetaclass):
+    # 命名的列组合，例如dict(card=('id', 'name'))，通过Query.project或findAll(projection=)使用
+    __projections__ = {}
+    # 部分Model只包含查询的列，值为列名tuple，不能保存或更新
+    __partial__ = None
+    # 为True时查询默认返回紧凑的Record，见Query.compact
+    __compact__ = False
+    # 查询结果缓存的秒数，0为不缓存，需要先调用enable_cache
+    __cache_ttl__ = 0
+    # 组合索引和组合唯一索引，例如(('blog_id', 'created_at'),)，单列索引在Field上声明
+    __indexes__ = ()
+    __unique__ = ()
+
     def __init__(self, **kw):
         super(Model, self).__init__(**kw)
 
+    # 返回只包含columns列的部分Model类，它是cls的子类，相同的列只生成一次
+    @classmethod
+    def partial(cls, columns):
+        key = (cls, tuple(columns))
+        partial = _partial_classes.get(key)
+        if partial is None:
+            # 直接调用type.__new__，跳过ModelMetaclass对字段的处理，映射关系从cls继承
+            partial = type.__new__(ModelMetaclass, cls.__name__, (cls,), dict(__partial__=key[1], __module__=cls.__module__))
+            partial.__from_row__ = staticmethod(_gen_from_row(partial, key[1]))
+            _partial_classes[key] = partial
+        return partial
+
+    # 返回只包含columns列的Record类，columns为None时包含全部列
+    @classmethod
+    def record(cls, columns=None):
+        if columns is None:
+            return cls.__record__
+        key = (cls, 'record', tuple(columns))
+        record = _partial_classes.get(key)
+        if record is None:
+            record = _make_record(cls, key[2])
+            _partial_classes[key] = record
+        return record
+
+    def _check_complete(self, action):
+        if self.__partial__ is not None:
+            raise RuntimeError('Cannot %s partial %s with columns: %s' % (action, self.__class__.__name__, ', '.join(self.__partial__)))
+
     # 获取某个属性的值，这里是某个列字段的值
     def __getattr__(self, key):
         try:
@@ -185,6 +1488,10 @@ class Model(dict, metaclass=ModelMetaclass):
     def getValue(self, key):
         return getattr(self, key, None)
 
+    # 返回keyset分页的游标值
+    def getKeyset(self):
+        return [self.getValue(k) for k in self.__keyset__]
+
     def getValueOrDefault(self, key):
         value = getattr(self, key, None)
         if value is None:
@@ -196,76 +1503,194 @@ class Model(dict, metaclass=ModelMetaclass):
                 setattr(self, key, value)
         return value
 
+    # 返回该Model的查询对象，可继续链式调用where/order/limit/columns
+    @classmethod
+    def query(cls):
+        return Query(cls)
+
+    # 在请求作用域内，先查identity map，否则与同一tick内的其他find合并为一次查询，
+    # 事务中直接在事务连接上查询
     @classmethod
-    @asyncio.coroutine
-    def find(cls, pk):
-        rs = yield from select('%s where `%s`=?' % (cls.__select__, cls.__primary_key__), [pk], 1)
+    async def find(cls, pk):
+        s = _scope.get()
+        if s is not None and cls.__partial__ is None and _current_transaction() is None:
+            known = s.identity.get(cls)
+            if known is not None and pk in known:
+                return known[pk]
+            # shield保证某个调用方被取消时不影响其他等待同一结果的调用方
+            return await asyncio.shield(s.loader(cls).load(pk))
+        rs = await select(cls.__find__, [pk], 1, tuples=True, model=cls)
         if len(rs) == 0:
             return None
-        return cls(**rs[0])
+        return cls.__from_row__(rs[0])
 
+    # 按主键批量查询，返回与ids顺序一致的列表，不存在的主键对应None，
+    # 请求作用域内已知的主键不再查询，查询结果写入identity map
     @classmethod
-    @asyncio.coroutine
-    def findAll(cls, where=None, args=None, **kw):
-        # 初始化一个sql列表
-        sql = [cls.__select__]
-        if where:
-            sql.append('where')
-            sql.append(where)
-        if args is None:
-            args = []
-        orderBy = kw.get('orderBy', None)
-        if orderBy:
-            sql.append('order by')
-            sql.append(orderBy)
+    async def find_many(cls, ids):
+        ids = list(ids)
+        s = _scope.get() if cls.__partial__ is None else None
+        known = s.identity.setdefault(cls, dict()) if s is not None else dict()
+        missing = list(dict.fromkeys(pk for pk in ids if pk not in known))
+        for n in range(0, len(missing), _IN_MAX):
+            chunk = missing[n:n + _IN_MAX]
+            rs = await select(cls._find_many_sql(len(chunk)), chunk, tuples=True, model=cls)
+            found = dict((r[0], cls.__from_row__(r)) for r in rs)
+            for pk in chunk:
+                known[pk] = found.get(pk)
+        return [known.get(pk) for pk in ids]
+
+    @classmethod
+    def _find_many_sql(cls, n):
+        key = (cls.__table__, 'in', n)
+        sql = _query_cache.get(key)
+        if sql is None:
+            sql = compile_sql('%s where `%s` in (%s)' % (cls.__select__, cls.__primary_key__, create_args_string(n)))
+            if len(_query_cache) < _COMPILED_MAX:
+                _query_cache[key] = sql
+        return sql
+
+    # findAll和iterate的参数
+    _FIND_OPTIONS = frozenset(['orderBy', 'limit', 'compact', 'columns', 'projection', 'after', 'before', 'desc'])
+
+    # 由findAll/iterate的参数构造Query，不认识的参数抛出TypeError，避免被忽略
+    @classmethod
+    def _find_query(cls, where, args, kw):
+        unknown = set(kw) - cls._FIND_OPTIONS
+        if unknown:
+            raise TypeError('Unexpected arguments for %s query: %s' % (cls.__name__, ', '.join(sorted(unknown))))
+        q = Query(cls, where=where, args=args or (), orderBy=kw.get('orderBy', None))
         limit = kw.get('limit', None)
-        if limit:
-            sql.append('limit')
-            if isinstance(limit, int):
-                sql.append('?')
-                args.append(limit)
-            if isinstance(limit, tuple) and len(limit) == 2:
-                sql.append('?, ?')
-                args.extend(limit)
-            else:
-                raise ValueError('Invalid limit value: %s' % str(limit))
-        # 将之前拼接的sql列表以空格分开形成sql字符串，作为参数传递给select，args作为sql语句中占位符的参数
-        rs = yield from select(' '.join(sql), args)
-        return [cls(**r) for r in rs]
+        if limit is not None:
+            q = q.limit(limit)
+        # compact为True时返回Record
+        if kw.get('compact') is not None:
+            q = q.compact(kw['compact'])
+        # columns或projection只查询部分列，返回部分Model
+        if kw.get('columns'):
+            q = q.columns(*kw['columns'])
+        if kw.get('projection'):
+            q = q.project(kw['projection'])
+        # after/before为keyset游标，见Query.seek
+        if kw.get('after') is not None or kw.get('before') is not None:
+            q = q.seek(kw.get('after'), kw.get('before'), kw.get('desc', True))
+        return q
+
+    @classmethod
+    async def findAll(cls, where=None, args=None, **kw):
+        return await cls._find_query(where, args, kw).all()
+
+    # 流式遍历查询结果，参数与findAll相同，见RowIterator
+    @classmethod
+    def iterate(cls, where=None, args=None, batch_size=1000, **kw):
+        return cls._find_query(where, args, kw).iterate(batch_size)
 
     @classmethod
-    @asyncio.coroutine
-    def findNumber(cls, selectField, where=None, args=None):
+    async def findNumber(cls, selectField, where=None, args=None):
         # select count() from table
-        sql = ['select %s _num_ from `%s`' % (selectField, cls.__table__)]
-        if where:
-            sql.append('where')
-            sql.append(where)
-        rs = yield from select(' '.join(sql), args, 1)
-        if len(rs) == 0:
-            return None
-        return rs[0]['_num_']
+        return await Query(cls, where=where, args=args or ()).number(selectField)
+
+    # 返回一次插入n行的多行insert语句，按行数缓存
+    @classmethod
+    def _insert_many_sql(cls, n):
+        key = (cls.__table__, 'insert', n)
+        sql = _query_cache.get(key)
+        if sql is None:
+            row = '(%s)' % create_args_string(len(cls.__fields__) + 1)
+            head = cls.__insert__[:cls.__insert__.rindex(' values ')]
+            sql = compile_sql('%s values %s' % (head, ', '.join([row] * n)))
+            if len(_query_cache) < _COMPILED_MAX:
+                _query_cache[key] = sql
+        return sql
+
+    # 批量插入，models可以是任意可迭代对象（包括生成器），每chunk_size行合并为一条多行insert，
+    # 所有chunk共用一个连接，transaction为True时在同一事务内写入，返回每个chunk的结果数
+    @classmethod
+    async def save_many(cls, models, chunk_size=100, transaction=False):
+        if chunk_size < 1:
+            raise ValueError('Invalid chunk size: %s' % chunk_size)
+        width = len(cls.__fields__) + 1
+
+        def statements():
+            chunk = []
+            for m in models:
+                m._check_complete('save')
+                # 默认值由生成的_insert_args填充
+                chunk.extend(m._insert_args())
+                if len(chunk) == chunk_size * width:
+                    yield cls._insert_many_sql(chunk_size), chunk
+                    chunk = []
+            if chunk:
+                yield cls._insert_many_sql(len(chunk) // width), chunk
+
+        rows = await execute_batch(statements(), autocommit=not transaction)
+        _written(cls)
+        logging.info('bulk insert into %s: affected rows per chunk: %s' % (cls.__table__, rows))
+        return rows
+
+    # 返回按条件批量更新的(sql, args)，values为{属性名: 新值}
+    @classmethod
+    def update_where_statement(cls, values, where, args=None):
+        names = tuple(sorted(values.keys()))
+        if not names:
+            raise ValueError('No values to update for %s' % cls.__name__)
+        for name in names:
+            if name not in cls.__mappings__:
+                raise ValueError('Unknown column for %s: %s' % (cls.__name__, name))
+        key = (cls.__table__, 'update', names, where)
+        sql = _query_cache.get(key)
+        if sql is None:
+            sql = compile_sql('update `%s` set %s where %s' % (
+                cls.__table__, ', '.join('`%s`=?' % (cls.__mappings__[n].name or n) for n in names), where))
+            if len(_query_cache) < _COMPILED_MAX:
+                _query_cache[key] = sql
+        return sql, [values[n] for n in names] + list(args or ())
+
+    # 返回按条件批量删除的(sql, args)
+    @classmethod
+    def delete_where_statement(cls, where, args=None):
+        key = (cls.__table__, 'delete', where)
+        sql = _query_cache.get(key)
+        if sql is None:
+            sql = compile_sql('delete from `%s` where %s' % (cls.__table__, where))
+            if len(_query_cache) < _COMPILED_MAX:
+                _query_cache[key] = sql
+        return sql, list(args or ())
+
+    # 按条件批量更新，一条语句完成，返回结果数
+    @classmethod
+    async def update_where(cls, values, where, args=None):
+        sql, args = cls.update_where_statement(values, where, args)
+        rows = await execute(sql, args)
+        _written(cls)
+        return rows
+
+    # 按条件批量删除，一条语句完成，返回结果数
+    @classmethod
+    async def delete_where(cls, where, args=None):
+        sql, args = cls.delete_where_statement(where, args)
+        rows = await execute(sql, args)
+        _written(cls)
+        return rows
 
-    @asyncio.coroutine
-    def save(self):
-        args = list(map(self.getValueOrDefault, self.__fields__))
-        args.append(self.getValueOrDefault(self.__primary_key__))
-        rows = yield from execute(self.__insert__, args)
+    async def save(self):
+        self._check_complete('save')
+        rows = await execute(self.__insert__, self._insert_args())
+        _written(self.__class__, self)
         if rows != 1:
             logging.warning('fail to insert record: affected rows: %s' % rows)
 
-    @asyncio.coroutine
-    def update(self):
-        args = list(map(self.getValue, self.__fields__))
-        args.append(self.getValue(self.__primary_key__))
-        rows = yield from execute(self.__update__, args)
+    async def update(self):
+        self._check_complete('update')
+        rows = await execute(self.__update__, self._update_args())
+        _written(self.__class__, self)
         if rows != 1:
             logging.warning('failed to update by primary key: affected rows: %s' % rows)
 
-    @asyncio.coroutine
-    def remove(self):
+    async def remove(self):
         args = [self.getValue(self.__primary_key__)]
-        rows = yield from execute(self.__delete__, args)
+        rows = await execute(self.__delete__, args)
+        _written(self.__class__, self, removed=True)
         if rows != 1:
             logging.warning('failed to remove by primary key: affected rows: %s' % rows)
 
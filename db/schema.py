@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+
+"""
+由Model的__mappings__生成建表语句，并与数据库中的索引对比，找出缺少的列和索引。
+索引来自Field的index/unique参数和Model的__indexes__/__unique__声明。
+用法：在项目根目录执行
+    python -m db.schema          输出db.models中所有表的建表语句
+    python -m db.schema --diff   连接配置中的数据库，输出缺少的表、列和索引的DDL
+"""
+
+import asyncio
+import inspect
+import sys
+
+from db import orm
+
+
+def column_name(model, key):
+    return model.__mappings__[key].name or key
+
+
+# 返回Model的所有索引，每项为(索引名, 是否唯一, 列名tuple)
+def indexes(model):
+    result = []
+    for key in [model.__primary_key__] + model.__fields__:
+        field = model.__mappings__[key]
+        if field.unique:
+            result.append((True, (column_name(model, key),)))
+        elif field.index:
+            result.append((False, (column_name(model, key),)))
+    for columns in model.__unique__:
+        result.append((True, tuple(column_name(model, c) for c in columns)))
+    for columns in model.__indexes__:
+        result.append((False, tuple(column_name(model, c) for c in columns)))
+    return [(('uniq_' if unique else 'idx_') + '_'.join(columns), unique, columns) for unique, columns in result]
+
+
+def column_ddl(model, key):
+    return '`%s` %s not null' % (column_name(model, key), model.__mappings__[key].column_type)
+
+
+def create_table(model):
+    lines = []
+    for key in [model.__primary_key__] + model.__fields__:
+        lines.append(column_ddl(model, key))
+    lines.append('primary key (`%s`)' % column_name(model, model.__primary_key__))
+    for name, unique, columns in indexes(model):
+        lines.append('%skey `%s` (%s)' % ('unique ' if unique else '', name, ', '.join('`%s`' % c for c in columns)))
+    return 'create table `%s` (\n    %s\n) engine=innodb default charset=utf8mb4;' % (model.__table__, ',\n    '.join(lines))
+
+
+def create_index(model, name, unique, columns):
+    return 'create %sindex `%s` on `%s` (%s);' % ('unique ' if unique else '', name, model.__table__,
+                                                   ', '.join('`%s`' % c for c in columns))
+
+
+# 返回模块中定义的所有Model
+def models_in(module):
+    return [m for m in vars(module).values()
+            if inspect.isclass(m) and issubclass(m, orm.Model) and m is not orm.Model and m.__module__ == module.__name__]
+
+
+def schema(models):
+    return '\n\n'.join(create_table(m) for m in models)
+
+
+# 读取当前数据库中的索引，返回{表名: [(是否唯一, 列名tuple)]}
+async def live_indexes():
+    rows = await orm.select('select `table_name` as t, `index_name` as i, `non_unique` as n, `column_name` as c '
+                            'from information_schema.statistics where `table_schema`=database() '
+                            'order by `table_name`, `index_name`, `seq_in_index`', [], tuples=True)
+    found = dict()
+    for table, index, non_unique, column in rows:
+        found.setdefault((table, index), (not non_unique, []))[1].append(column)
+    result = dict()
+    for (table, index), (unique, columns) in found.items():
+        result.setdefault(table, []).append((unique, tuple(columns)))
+    return result
+
+
+# 声明的索引是否已存在：列相同的索引，或以这些列开头的索引（唯一索引必须列完全相同）
+def _covered(unique, columns, existing):
+    for live_unique, live_columns in existing:
+        if unique:
+            if live_unique and live_columns == columns:
+                return True
+        elif live_columns[:len(columns)] == columns:
+            return True
+    return False
+
+
+# 与数据库对比，返回缺少的表、列和索引的DDL列表
+async def diff(models):
+    tables = dict()
+    for table, column in await orm.select('select `table_name`, `column_name` from information_schema.columns '
+                                          'where `table_schema`=database()', [], tuples=True):
+        tables.setdefault(table, set()).add(column)
+    live = await live_indexes()
+    statements = []
+    for model in models:
+        if model.__table__ not in tables:
+            statements.append(create_table(model))
+            continue
+        for key in model.__fields__:
+            if column_name(model, key) not in tables[model.__table__]:
+                default = model.__mappings__[key].default
+                statements.append('alter table `%s` add column %s%s;' % (
+                    model.__table__, column_ddl(model, key),
+                    '' if default is None or callable(default) else ' default %r' % (default,)))
+        for name, unique, columns in indexes(model):
+            if not _covered(unique, columns, live.get(model.__table__, ())):
+                statements.append(create_index(model, name, unique, columns))
+    return statements
+
+
+async def main(models):
+    from www.config.config import configs
+    await orm.create_pool(None, **configs['db'])
+    statements = await diff(models)
+    print('\n'.join(statements) if statements else '-- schema is up to date')
+
+
+if __name__ == '__main__':
+    from db import models
+    if '--diff' in sys.argv[1:]:
+        asyncio.run(main(models_in(models)))
+    else:
+        print(schema(models_in(models)))
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+# 测量RequestHandler每个请求的参数绑定和调用开销，不需要连接数据库
+# 用法：python test/bench_dispatch.py [REV]
+# REV为生成参数绑定函数之前的git版本（例如5543806），给出时从该版本加载通用的RequestHandler一起对比
+import asyncio
+import logging
+import os
+import subprocess
+import sys
+import time
+import types
+
+from urllib import parse
+
+from multidict import MultiDict, MultiDictProxy
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'www'))
+sys.path.insert(0, ROOT)
+
+import coroweb
+from coroweb import get, post
+
+N = 20000
+
+
+@get('/api/blogs')
+async def api_blogs(*, page='1', cursor=None):
+    return page
+
+
+@get('/blog/{id}')
+async def get_blog(request, *, id):
+    return id
+
+
+@post('/api/blogs/{id}/comments')
+async def api_create_comment(id, request, *, content):
+    return content
+
+
+@get('/manage/')
+def manage():
+    return 'redirect:/manage/comments'
+
+
+# 只包含RequestHandler用到的属性的request，make_mocked_request太慢，不适合大量构造。
+# query与aiohttp一样在第一次访问时解析并缓存
+class Request(object):
+
+    def __init__(self, method, path, query_string='', match_info=None, content_type='application/octet-stream'):
+        self.method = method
+        self.path = path
+        self.query_string = query_string
+        self.match_info = match_info or {}
+        self.content_type = content_type
+        self._query = None
+
+    @property
+    def query(self):
+        if self._query is None:
+            self._query = MultiDictProxy(MultiDict(parse.parse_qsl(self.query_string, keep_blank_values=True)))
+        return self._query
+
+    async def json(self):
+        return dict(content='hello')
+
+
+# 每个请求使用新的request对象，避免缓存的query影响结果
+def requests(case):
+    result = []
+    for n in range(N):
+        if case == 'api_blogs':
+            r = Request('GET', '/api/blogs', 'page=%d' % (n % 10))
+        elif case == 'get_blog':
+            r = Request('GET', '/blog/%d' % n, match_info=dict(id=str(n)))
+        elif case == 'api_create_comment':
+            r = Request('POST', '/api/blogs/%d/comments' % n, match_info=dict(id=str(n)), content_type='application/json')
+        else:
+            r = Request('GET', '/manage/')
+        result.append(r)
+    return result
+
+
+def load_legacy(rev):
+    source = subprocess.check_output(['git', 'show', '%s:www/coroweb.py' % rev], cwd=ROOT)
+    mod = types.ModuleType('legacy_coroweb')
+    exec(compile(source, 'legacy_coroweb.py', 'exec'), mod.__dict__)
+    return mod
+
+
+async def measure(handler, reqs):
+    start = time.perf_counter()
+    for r in reqs:
+        await handler(r)
+    return (time.perf_counter() - start) / len(reqs) * 1e9
+
+
+async def main(rev):
+    legacy = load_legacy(rev) if rev else None
+    for fn in (api_blogs, get_blog, api_create_comment, manage):
+        case = fn.__name__
+        t = await measure(coroweb.RequestHandler(None, fn), requests(case))
+        line = '%-20s binder: %7.0f ns/req' % (case, t)
+        if legacy:
+            t0 = await measure(legacy.RequestHandler(None, fn), requests(case))
+            line = '%-20s generic: %7.0f ns/req  binder: %7.0f ns/req  speedup: %.2fx' % (case, t0, t, t0 / t)
+        print(line)
+
+
+if __name__ == '__main__':
+    logging.disable(logging.INFO)
+    asyncio.run(main(sys.argv[1] if len(sys.argv) > 1 else None))
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+# 对比response_factory原来的json.dumps(default=json_default)与jsonenc.dumps序列化API响应的耗时，不需要连接数据库
+# 用法：python test/bench_json.py
+# 负载与/api/blogs（每页10条博客卡片）和/api/comments（每页10条评论）的返回值相同，另有/api/users的完整Model
+import json
+import os
+import sys
+import time
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'www'))
+sys.path.insert(0, ROOT)
+
+import jsonenc
+from apis import Page
+from db.models import Blog, Comment, User
+
+N = 20000
+
+
+# 原来的处理方式
+def json_default(o):
+    if hasattr(o, '_asdict'):
+        return o._asdict()
+    return o.__dict__
+
+
+def legacy_dumps(r):
+    return json.dumps(r, ensure_ascii=False, default=json_default).encode('utf-8')
+
+
+def page():
+    p = Page(1000, 2)
+    p.set_cursors(['1500000000.0', '0000000000001'], ['1500000001.0', '0000000000010'])
+    return p
+
+
+def api_blogs():
+    card = Blog.record(Blog.__projections__['card'])
+    blogs = [card('%013d' % n, '001500000000000' + 'a' * 35, '管理员', 'http://www.gravatar.com/avatar/%032d?d=mm&s=120' % n,
+                  '第%s篇博客' % n, '这是一段博客摘要，' * 10, time.time()) for n in range(10)]
+    return dict(page=page(), blogs=blogs)
+
+
+def api_comments():
+    comments = [Comment.__record__('%013d' % n, '%013d' % (n // 3), '001500000000000' + 'b' * 35, 'reader',
+                                   'http://www.gravatar.com/avatar/%032d?d=mm&s=120' % n,
+                                   'A comment with some **markdown** and 中文内容。' * 5, time.time()) for n in range(10)]
+    return dict(page=page(), comments=comments)
+
+
+def api_users():
+    users = [User(id='001500000000000' + 'c' * 35, email='user%s@example.com' % n, passwd='%040d' % n, admin=False,
+                  name='user%s' % n, image='http://www.gravatar.com/avatar/%032d?d=mm&s=120' % n,
+                  created_at=time.time()) for n in range(10)]
+    return dict(page=page(), users=users)
+
+
+def main():
+    print('backend: %s' % jsonenc.BACKEND)
+    for name, make in [('/api/blogs', api_blogs), ('/api/comments', api_comments), ('/api/users', api_users)]:
+        r = make()
+        # 结果应与原来相同，只是不再包含passwd
+        expected = json.loads(legacy_dumps(r).decode('utf-8'))
+        for item in expected.get('users', ()):
+            del item['passwd']
+        assert json.loads(jsonenc.dumps(r).decode('utf-8')) == expected
+        assert json.loads(jsonenc.dumps_json(r).decode('utf-8')) == expected
+        t0 = min(timeit.repeat(lambda: legacy_dumps(r), number=N, repeat=5)) / N * 1e6
+        t1 = min(timeit.repeat(lambda: jsonenc.dumps_json(r), number=N, repeat=5)) / N * 1e6
+        t2 = min(timeit.repeat(lambda: jsonenc.dumps(r), number=N, repeat=5)) / N * 1e6
+        print('%-14s %5d bytes  legacy: %6.1f us  jsonenc(json): %6.1f us  jsonenc(%s): %6.1f us  speedup: %.2fx'
+              % (name, len(jsonenc.dumps(r)), t0, t1, jsonenc.BACKEND, t2, t0 / t2))
+
+
+if __name__ == '__main__':
+    main()
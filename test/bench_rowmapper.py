@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+# 对比通用的行映射/参数构造与ModelMetaclass生成的专用函数的单行耗时，不需要连接数据库
+import time
+import timeit
+
+from db.models import Blog
+
+N = 200000
+
+columns = [Blog.__primary_key__] + Blog.__fields__
+row = ('0015000000000000000000000000000000000000000000000', 'uid', 'name', 'about:blank',
+       'title', 'summary', 'content ' * 100, time.time())
+dict_row = dict(zip(columns, row))
+blog = Blog(**dict_row)
+
+
+def generic_from_row():
+    # DictCursor返回的dict，再复制到Model
+    return Blog(**dict(zip(columns, row)))
+
+
+def generated_from_row():
+    return Blog.__from_row__(row)
+
+
+def generated_record():
+    return Blog.__record__(*row)
+
+
+def generic_insert_args():
+    args = list(map(blog.getValueOrDefault, Blog.__fields__))
+    args.append(blog.getValueOrDefault(Blog.__primary_key__))
+    return args
+
+
+def generated_insert_args():
+    return blog._insert_args()
+
+
+def generic_update_args():
+    args = list(map(blog.getValue, Blog.__fields__))
+    args.append(blog.getValue(Blog.__primary_key__))
+    return args
+
+
+def generated_update_args():
+    return blog._update_args()
+
+
+record = Blog.__record__(*row)
+
+
+def generic_asdict():
+    return dict((k, getattr(record, k)) for k in record.__columns__)
+
+
+def generated_asdict():
+    return record._asdict()
+
+
+assert generic_from_row() == generated_from_row()
+assert generic_insert_args() == generated_insert_args()
+assert generic_update_args() == generated_update_args()
+assert generic_asdict() == generated_asdict()
+
+for name, generic, generated in [
+        ('row -> Model', generic_from_row, generated_from_row),
+        ('row -> Record', generic_from_row, generated_record),
+        ('insert args', generic_insert_args, generated_insert_args),
+        ('update args', generic_update_args, generated_update_args),
+        ('Record -> dict', generic_asdict, generated_asdict)]:
+    t1 = min(timeit.repeat(generic, number=N, repeat=3)) / N * 1e9
+    t2 = min(timeit.repeat(generated, number=N, repeat=3)) / N * 1e9
+    print('%-16s generic: %7.1f ns/row  generated: %7.1f ns/row  speedup: %.2fx' % (name, t1, t2, t1 / t2))
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+# 对比@asyncio.coroutine/yield from与async/await两种写法下，请求经过middleware和RequestHandler的吞吐量，不需要连接数据库
+# 用法：python test/bench_throughput.py [REV]
+# REV为async/await改写之前的git版本（例如35244c0），给出时从该版本加载旧的coroweb一起对比
+import asyncio
+import functools
+import inspect
+import logging
+import os
+import subprocess
+import sys
+import time
+import types
+
+from aiohttp.test_utils import make_mocked_request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'www'))
+sys.path.insert(0, ROOT)
+
+import coroweb
+
+N = 20000
+CONCURRENCY = 100
+LAYERS = 4
+
+
+# 新写法：原生协程的middleware和handler，普通函数直接调用
+async def native_middleware(app, handler):
+    async def middleware(request):
+        return await handler(request)
+    return middleware
+
+
+async def native_handler(request, *, page='1'):
+    return dict(page=page, path=request.path)
+
+
+def sync_handler(request, *, page='1'):
+    return dict(page=page, path=request.path)
+
+
+# Python 3.11已删除asyncio.coroutine，这里按其原有行为补上，仅用于加载旧版本的代码
+def legacy_coroutine(fn):
+    if inspect.isgeneratorfunction(fn):
+        return types.coroutine(fn)
+
+    @functools.wraps(fn)
+    @types.coroutine
+    def wrapper(*args, **kw):
+        r = fn(*args, **kw)
+        if inspect.isawaitable(r):
+            r = yield from r.__await__()
+        return r
+    return wrapper
+
+
+def load_legacy(rev):
+    if not hasattr(asyncio, 'coroutine'):
+        asyncio.coroutine = legacy_coroutine
+    source = subprocess.check_output(['git', 'show', '%s:www/coroweb.py' % rev], cwd=ROOT)
+    mod = types.ModuleType('legacy_coroweb')
+    exec(compile(source, 'legacy_coroweb.py', 'exec'), mod.__dict__)
+    return mod
+
+
+def legacy_middleware(app, handler):
+    @asyncio.coroutine
+    def middleware(request):
+        return (yield from handler(request))
+    return middleware
+
+
+# 旧写法的handler是生成器函数
+def legacy_handler(request, *, page='1'):
+    return dict(page=page, path=request.path)
+    yield
+
+
+async def build(factory, handler):
+    for _ in range(LAYERS):
+        r = factory(None, handler)
+        handler = (await r) if inspect.isawaitable(r) else r
+    return handler
+
+
+async def measure(handler):
+    request = make_mocked_request('GET', '/api/blogs?page=2')
+
+    async def worker(n):
+        for _ in range(n):
+            await handler(request)
+
+    await worker(100)
+    start = time.perf_counter()
+    await asyncio.gather(*[worker(N // CONCURRENCY) for _ in range(CONCURRENCY)])
+    return N / (time.perf_counter() - start)
+
+
+async def main(rev):
+    cases = [
+        ('async def handler', await build(native_middleware, coroweb.RequestHandler(None, native_handler))),
+        ('sync handler', await build(native_middleware, coroweb.RequestHandler(None, sync_handler)))
+    ]
+    if rev:
+        legacy = load_legacy(rev)
+        # 旧版add_route用asyncio.coroutine包装普通函数
+        cases[:0] = [
+            ('legacy generator handler', await build(legacy_middleware, legacy.RequestHandler(None, asyncio.coroutine(legacy_handler)))),
+            ('legacy sync handler', await build(legacy_middleware, legacy.RequestHandler(None, asyncio.coroutine(sync_handler))))
+        ]
+    base = None
+    for name, handler in cases:
+        rate = await measure(handler)
+        base = base or rate
+        print('%-26s %9.0f req/s  %.2fx' % (name, rate, rate / base))
+
+
+if __name__ == '__main__':
+    logging.disable(logging.INFO)
+    asyncio.run(main(sys.argv[1] if len(sys.argv) > 1 else None))
@@ -2,20 +2,19 @@ import asyncio
 import logging
 
 from aiohttp import web
-from www.coroweb import add_routes, add_static
-from www.app import init_jinja2, datetime_filter, logger_factory, response_factory, auth_factory
+from www.coroweb import add_routes, add_static, add_middlewares
+from www.app import init_jinja2, datetime_filter, logger_factory, deadline_factory, scope_factory, response_factory, auth_factory
 from db import orm
 from www.config.config import configs
 
 logging.basicConfig(level=logging.INFO)
 
 
-@asyncio.coroutine
-def init(loop):
+async def init(loop):
     # 创建数据库连接池，从config导入配置
-    yield from orm.create_pool(loop, **configs['db'])
+    await orm.create_pool(loop, **configs['db'])
     # 指定拦截器
-    app = web.Application(loop=loop, middlewares=[logger_factory, response_factory, auth_factory])
+    app = web.Application(loop=loop)
     # 初始化jinja2，
     init_jinja2(
         app,
@@ -23,7 +22,8 @@ def init(loop):
         path=r'C:\Users\zhuangda\Desktop\programing\blog\www\templates')
     add_routes(app, 'www.handlers')
     add_static(app, path=r'C:\Users\zhuangda\Desktop\programing\blog\www\static')
-    srv = yield from loop.create_server(app.make_handler(), '127.0.0.1', 9000)
+    await add_middlewares(app, [logger_factory, deadline_factory, scope_factory, response_factory, auth_factory])
+    srv = await loop.create_server(app.make_handler(), '127.0.0.1', 9000)
     logging.info('Server started at http://127.0.0.1:9000...')
     return srv
 
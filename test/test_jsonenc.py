@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+# JSON序列化的测试：两种后端（安装了orjson时的dumps和标准库的dumps_json）输出相同，
+# 嵌套在Model、Record、list和dict中的User都不输出passwd，不需要连接数据库
+# 用法：在项目根目录执行 python test/test_jsonenc.py
+import json
+import logging
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'www'))
+sys.path.insert(0, ROOT)
+
+logging.disable(logging.INFO)
+
+import jsonenc
+from apis import APIValueError, Page
+from db.models import Blog, User
+
+SECRET = 'secret-passwd'
+
+
+def user():
+    return User(id='u1', email='e', passwd=SECRET, admin=False, name='名字', image='i', created_at=1.0)
+
+
+def record():
+    return User.__record__('u2', 'e', SECRET, True, 'n', 'i', 2.0)
+
+
+def cases():
+    return [
+        ('model', user()),
+        ('record', record()),
+        ('model in model', Blog(id='b1', name='n', comments=[user()], author=user())),
+        ('record in model', Blog(id='b1', readers=(record(),))),
+        ('model in object', dict(page=Page(3), items=[dict(user=user())], error=APIValueError('email'))),
+    ]
+
+
+def test_hidden():
+    for name, value in cases():
+        for dumps in (jsonenc.dumps, jsonenc.dumps_json):
+            b = dumps(value)
+            assert isinstance(b, bytes), name
+            assert b'passwd' not in b and SECRET.encode('utf-8') not in b, (name, dumps.__name__, b)
+
+
+def test_backends_agree():
+    for name, value in cases():
+        assert json.loads(jsonenc.dumps(value)) == json.loads(jsonenc.dumps_json(value)), name
+
+
+def test_nested_values():
+    d = json.loads(jsonenc.dumps_json(Blog(id='b1', comments=[user()])))
+    assert d['comments'][0] == dict(id='u1', email='e', admin=False, name='名字', image='i', created_at=1.0), d
+
+
+if __name__ == '__main__':
+    print('backend: %s' % jsonenc.BACKEND)
+    for test in (test_hidden, test_backends_agree, test_nested_values):
+        test()
+        print('%s: ok' % test.__name__)
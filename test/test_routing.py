@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+# 读写路由的测试：用本地的替身连接池代替主库和两个只读副本（按端口区分），不需要连接数据库，
+# 检查未完成请求最少的副本优先、相同时轮流选择，以及写入后sticky时间内读主库
+# 用法：在项目根目录执行 python test/test_routing.py
+import asyncio
+import logging
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db.orm as orm
+
+STICKY = 0.2
+
+
+# 替身服务器的连接，记录执行的语句，select返回提供服务的端口
+class StandInCursor(object):
+
+    def __init__(self, server):
+        self.server = server
+        self.rowcount = 0
+        self._rows = []
+
+    async def execute(self, sql, args=None):
+        self.server.executed.append(sql)
+        self._rows = [dict(port=self.server.port)]
+        self.rowcount = 1
+
+    async def fetchall(self):
+        rows, self._rows = self._rows, []
+        return rows
+
+    async def fetchmany(self, size):
+        rows, self._rows = self._rows[:size], self._rows[size:]
+        return rows
+
+    async def close(self):
+        pass
+
+
+class StandInConnection(object):
+
+    def __init__(self, server):
+        self.server = server
+        self.closed = False
+
+    async def cursor(self, cursor_class=None):
+        return StandInCursor(self.server)
+
+    def close(self):
+        self.closed = True
+
+
+class StandInServer(object):
+
+    def __init__(self, port):
+        self.port = port
+        self.executed = []
+        self.size = 0
+        self.freesize = 0
+
+    async def acquire(self):
+        self.size += 1
+        return StandInConnection(self)
+
+    def release(self, conn):
+        self.freesize += 1
+
+
+servers = dict()
+
+
+async def create_stand_in_pool(**kw):
+    return servers.setdefault(kw['port'], StandInServer(kw['port']))
+
+
+def name(handle):
+    return handle.name
+
+
+async def test_least_outstanding():
+    # replica-0有两个未归还的连接，读操作都应选择replica-1
+    replica = orm._route_read()
+    other = [h for h in orm.pool_stats() if h not in ('primary', replica.name)][0]
+    conns = [await replica.acquire(), await replica.acquire()]
+    for _ in range(4):
+        assert name(orm._route_read()) == other, orm.pool_stats()
+    for conn in conns:
+        replica.release(conn)
+
+
+async def test_rotation():
+    # 未完成请求数相同时在两个副本间轮流选择
+    chosen = [name(orm._route_read()) for _ in range(6)]
+    assert set(chosen) == {'replica-0', 'replica-1'}, chosen
+    assert all(a != b for a, b in zip(chosen, chosen[1:])), chosen
+
+
+async def test_sticky():
+    # 写入后sticky时间内本上下文读主库，其他上下文仍读副本，超时后恢复读副本
+    async def writer():
+        await orm.execute('update `users` set `name`=? where `id`=?', ['n', '1'])
+        assert name(orm._route_read()) == 'primary'
+        rs = await orm.select('select `name` from `users` where `id`=?', ['1'])
+        assert rs[0]['port'] == 3306, rs
+        await asyncio.sleep(STICKY * 1.5)
+        assert name(orm._route_read()) != 'primary'
+
+    async def reader():
+        await asyncio.sleep(STICKY / 4)
+        assert name(orm._route_read()) != 'primary'
+        rs = await orm.select('select `name` from `users` where `id`=?', ['2'])
+        assert rs[0]['port'] in (3307, 3308), rs
+
+    await asyncio.gather(asyncio.ensure_future(writer()), asyncio.ensure_future(reader()))
+    assert servers[3306].executed[0].startswith('update')
+
+
+async def main():
+    orm.aiomysql.create_pool = create_stand_in_pool
+    await orm.create_pool(None, user='www-data', password='www-data', db='awesome', port=3306, sticky=STICKY,
+                          deadline_hint=False, replicas=[dict(port=3307), dict(port=3308)])
+    for test in (test_least_outstanding, test_rotation, test_sticky):
+        await test()
+        print('%s: ok' % test.__name__)
+
+
+if __name__ == '__main__':
+    logging.disable(logging.INFO)
+    asyncio.run(main())
@@ -1,5 +1,8 @@
 # -*- coding: utf-8 -*-
 
+import base64
+import json
+
 
 # 定义一个APIError的基类
 class APIError(Exception):
@@ -49,8 +52,40 @@ class Page(object):
             self.limit = self.page_size
         self.has_next = self.page_index < self.page_count
         self.has_previous = self.page_index > 1
+        # keyset分页游标，由当前页的首尾记录生成，翻页时传回可跳过offset扫描
+        self.next_cursor = None
+        self.previous_cursor = None
+
+    # 根据当前页首尾记录的keyset值生成前后页的游标
+    def set_cursors(self, first, last):
+        if self.has_next:
+            self.next_cursor = encode_cursor('after', last)
+        if self.has_previous:
+            self.previous_cursor = encode_cursor('before', first)
     # 如果要把一个类的实例变成 str，就需要实现特殊方法__str__()，这里把Page变成一个字符串
     def __str__(self):
         return 'item_count: %s, page_count: %s, page_index: %s, page_size: %s, offset: %s, limit: %s' \
                % (self.item_count, self.page_count, self.page_index, self.page_size, self.offset, self.limit)
     __repr__ = __str__
+
+
+# 游标为不透明的字符串，内容为方向和keyset值
+def encode_cursor(direction, values):
+    s = json.dumps([direction[0], list(values)], separators=(',', ':'))
+    return base64.urlsafe_b64encode(s.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+# 解析游标，返回(方向, keyset值)，格式错误或值不是字符串、数字时抛出APIValueError
+def decode_cursor(cursor):
+    try:
+        s = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        d, values = json.loads(s.decode('utf-8'))
+        direction = dict(a='after', b='before')[d]
+        if not isinstance(values, list):
+            raise ValueError(values)
+        for v in values:
+            if type(v) not in (str, int, float):
+                raise ValueError(v)
+    except (ValueError, TypeError, KeyError):
+        raise APIValueError('cursor', 'invalid cursor.')
+    return direction, tuple(values)
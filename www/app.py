@@ -1,7 +1,6 @@
 # -*- coding: utf-8 -*-
 
 import asyncio
-import json
 import logging
 import os
 import time
@@ -9,10 +8,11 @@ from datetime import datetime
 
 from aiohttp import web
 from jinja2 import Environment, FileSystemLoader
-from www.handlers import COOKIE_NAME, cookie2user
-from db import orm
+from www.handlers import COOKIE_NAME, cookie2user, init_sessions
+from db import ids, orm
 from www.config.config import configs
-from www.coroweb import add_routes, add_static
+from www.coroweb import add_routes, add_static, add_middlewares, middleware
+from www.jsonenc import dumps
 
 logging.basicConfig(level=logging.INFO)
 
@@ -55,25 +55,54 @@ def datetime_filter(t):
 
 # 以下为middleware，用于URL在被某个函数处理前，对URL的处理
 # 改变URL的输入、输出，或者直接返回
-# 接受一个app实例和一个handler作为参数，返回一个新的handler
-@asyncio.coroutine
-def logger_factory(app, handler):
-    @asyncio.coroutine
-    def logger(request):
+# 接受一个app实例和一个handler作为参数，返回一个新的handler，
+# 启动时按路由类别为每个路由组合一次，见coroweb.add_middlewares
+@middleware('page', 'api', 'anonymous')
+async def logger_factory(app, handler):
+    async def logger(request):
         # 记录request的方法和路径
         logging.info('Request: %s %s' % (request.method, request.path))
         # 继续处理请求
-        return (yield from handler(request))
+        return await handler(request)
     return logger
 
 
+# 该middleware为每个请求设置截止时间，超时的数据库查询会被中止，
+# 路由的timeout优先于配置中的默认值
+@middleware('page', 'api', 'anonymous')
+async def deadline_factory(app, handler):
+    async def deadline(request):
+        timeout = getattr(request.match_info.handler, 'timeout', None)
+        with orm.deadline(timeout or configs['deadline']['default']):
+            return await handler(request)
+    return deadline
+
+
+# 该middleware为每个请求开启ORM的请求作用域，同一请求内按主键查询的结果只查一次数据库，
+# 并发的find合并为一次批量查询
+@middleware('page', 'api', 'anonymous')
+async def scope_factory(app, handler):
+    async def scope(request):
+        with orm.scope():
+            return await handler(request)
+    return scope
+
+
 # 该middleware用于把handler处理过后的结果格式化为可正确显示的Response对象
-@asyncio.coroutine
-def response_factory(app, handler):
-    @asyncio.coroutine
-    def response(request):
+@middleware('page', 'api', 'anonymous')
+async def response_factory(app, handler):
+    async def response(request):
         logging.info('Response handler...')
-        r = yield from handler(request)
+        try:
+            r = await handler(request)
+        except orm.PoolTimeoutError as e:
+            # 数据库连接池已满，提示客户端稍后重试
+            logging.warning(e)
+            return web.HTTPServiceUnavailable(headers={'Retry-After': '1'})
+        except orm.QueryTimeoutError as e:
+            # 查询超过请求的截止时间，已被中止
+            logging.warning(e)
+            return web.HTTPGatewayTimeout()
         if isinstance(r, web.StreamResponse):
             return r
         if isinstance(r, bytes):
@@ -91,7 +120,7 @@ def response_factory(app, handler):
             template = r.get('__template__')
             # 若不含模板，JSON序列化结果输出
             if template is None:
-                resp = web.Response(body=json.dumps(r, ensure_ascii=False, default=lambda o: o.__dict__).encode('utf-8'))
+                resp = web.Response(body=dumps(r))
                 resp.content_type = 'application/json;charset=utf-8'
                 return resp
             else:
@@ -113,37 +142,50 @@ def response_factory(app, handler):
     return response
 
 
-# 改middleware用于在处理url之前解析cookie，并将登录用户绑定到request上，后续的url处理函数可以直接拿到登录用户
-@asyncio.coroutine
-def auth_factory(app, handler):
-    @asyncio.coroutine
-    def auth(request):
+# 改middleware用于在处理url之前解析cookie，并将登录用户绑定到request上，后续的url处理函数可以直接拿到登录用户，
+# 不读取登录用户的anonymous路由不需要查询数据库
+@middleware('page', 'api')
+async def auth_factory(app, handler):
+    async def auth(request):
         logging.info('check user: %s %s' % (request.method, request.path))
         request.__user__ = None
         # 取出本站登录cookie
         cookie_str = request.cookies.get(COOKIE_NAME)
         # 判断是否为合法cookie
         if cookie_str:
-            user = yield from cookie2user(cookie_str)
+            try:
+                user = await cookie2user(cookie_str)
+            except orm.PoolTimeoutError as e:
+                logging.warning(e)
+                return web.HTTPServiceUnavailable(headers={'Retry-After': '1'})
+            except orm.QueryTimeoutError as e:
+                logging.warning(e)
+                return web.HTTPGatewayTimeout()
             # 若是，将user信息写入request
             if user:
-                logging.info('set current user: %s' % user.email)
+                logging.info('set current user: %s' % user.id)
                 request.__user__ = user
         # 访问/manage/，检查是否为管理员
         if request.path.startswith('/manage/') and (request.__user__ is None or not request.__user__.admin):
             return web.HTTPFound('/signin')
-        return (yield from  handler(request))
+        return await handler(request)
     return auth
 
 
-@asyncio.coroutine
-def init(loop):
-    yield from orm.create_pool(loop=loop, **configs['db'])
-    app = web.Application(loop=loop, middlewares=[logger_factory, auth_factory, response_factory])
+async def init(loop):
+    await orm.create_pool(loop=loop, **configs['db'])
+    orm.enable_cache(**configs['cache'])
+    ids.configure(**configs['ids'])
+    if configs['explain']['enabled']:
+        orm.enable_explain(configs['explain']['report'])
+    if configs['session']['format'] == 'token':
+        await init_sessions()
+    app = web.Application(loop=loop)
     init_jinja2(app, filters=dict(datetime=datetime_filter))
     add_routes(app, 'handlers')
     add_static(app)
-    srv = yield from loop.create_server(app.make_handler(), '127.0.0.1', 9000)
+    await add_middlewares(app, [logger_factory, deadline_factory, scope_factory, auth_factory, response_factory])
+    srv = await loop.create_server(app.make_handler(), '127.0.0.1', 9000)
     logging.info('server started at http://127.0.0.1:9000...')
     return srv
 
@@ -6,9 +6,53 @@ configs = {
         'port': 3306,
         'user': 'www-data',
         'password': 'www-data',
-        'db': 'awesome'
+        'db': 'awesome',
+        'minsize': 1,
+        'maxsize': 10,
+        # 获取连接的超时时间，超时返回503
+        'acquire_timeout': 5.0,
+        # 是否根据等待情况在minsize和maxsize之间自动调整连接数
+        'adaptive': False,
+        # 慢查询的阈值（秒），超过的语句写入orm.slow日志，None为不记录
+        'slow_query': 0.5,
+        # 是否在select中加入MAX_EXECUTION_TIME提示，使超时的查询由服务器中止
+        'deadline_hint': True,
+        # 只读副本的配置列表，每项为与主库相同格式的dict，未给出的项沿用主库配置，例如：
+        # [{'host': '10.0.0.2'}, {'host': '10.0.0.3'}]；为空时读写都走主库
+        'replicas': [],
+        # 写入后sticky秒内，同一请求的读操作仍走主库，保证读到自己的写入
+        'sticky': 1.0
     },
     'session': {
-        'secret': 'zdblog'
+        'secret': 'zdblog',
+        # 已验证的登录cookie缓存的条数和秒数，其他进程对用户的修改最多在cache_ttl秒后生效
+        'cache_size': 10000,
+        'cache_ttl': 60.0,
+        # 登录cookie的格式：cookie为uid-过期时间-sha1，每次验证需要查询用户；
+        # token为签名的用户信息，验证时不查询数据库，切换前需要在users表中加入会话版本号列：
+        # alter table `users` add column `session_version` bigint not null default 0;
+        'format': 'cookie',
+        # 刷新会话版本号的间隔（秒），撤销的token最多在这段时间后失效
+        'refresh_interval': 30.0
+    },
+    'cache': {
+        'max_bytes': 16 * 1024 * 1024
+    },
+    'ids': {
+        # 主键生成器的worker（0-1023，0保留给迁移），每个进程必须不同，None时使用环境变量BLOG_WORKER_ID，
+        # 都没有时从本机未被占用的worker中租用一个；多台机器部署时必须为每个进程显式配置不重叠的worker
+        'worker': None,
+        # 租用worker的锁文件所在目录，None时使用系统临时目录，同一台机器上的进程必须相同
+        'lock_dir': None
+    },
+    'explain': {
+        # 开发时开启：每个sql模板第一次执行时运行EXPLAIN，标记全表扫描、filesort和临时表，退出时输出报告
+        'enabled': False,
+        # 报告文件的路径，None时只写日志
+        'report': None
+    },
+    'deadline': {
+        # 每个请求的默认处理时间（秒），超时的数据库查询会被中止并返回504，可用@get(path, timeout=...)按路由设置
+        'default': 10.0
     }
 }
\ No newline at end of file
@@ -1,25 +1,26 @@
 # -*- coding: utf-8 -*-
 
 import functools
-import asyncio
 import os
 import inspect
 import logging
+import re
 
-from urllib import parse
 from aiohttp import web
 from apis import APIError
 
 
-# 定义一个生成装饰器的模板，为装饰的函数添加URL信息
-def de_generator(path, *, method):
+# 定义一个生成装饰器的模板，为装饰的函数添加URL信息，
+# timeout为该路由处理请求的时间（秒），未设置时使用配置中的默认值，
+# route_class为路由的类别，未设置时由route_class()推断
+def de_generator(path, *, method, timeout=None, route_class=None):
+    # 直接在函数上记录URL信息，不再包装一层，这样协程函数仍然可以被识别为协程函数
     def decorator(func):
-        @functools.wraps(func)  # 把func的__name__等属性复制到wrapper()函数
-        def wrapper(*args, **kw):
-            return func(*args, **kw)
-        wrapper.__method__ = method
-        wrapper.__route__ = path
-        return wrapper
+        func.__method__ = method
+        func.__route__ = path
+        func.__timeout__ = timeout
+        func.__route_class__ = route_class
+        return func
     return decorator
 
 
@@ -85,83 +86,168 @@ def has_request_args(fn):
     return found
 
 
-# 封装一个URL处理函数
+# 路由路径中的参数，例如/blog/{id}或/blog/{id:\\w+}
+_RE_PATH_ARG = re.compile(r'\{(\w+)(?::[^}]*)?\}')
+
+
+# 读取POST请求的参数，格式不正确时返回400响应
+async def read_body(request):
+    # 必须要有数据提交格式
+    if not request.content_type:
+        return web.HTTPBadRequest(text='Missing Content-Type')
+    ct = request.content_type.lower()
+    # 对于JSON格式的处理
+    if ct.startswith('application/json'):
+        params = await request.json()
+        if not isinstance(params, dict):
+            return web.HTTPBadRequest(text='JSON body must be object.')
+        return params
+    # 对于以上两种格式，直接用post函数获取
+    if ct.startswith('application/x-www-form-urlencoded') or ct.startswith('multipart/form-data'):
+        return await request.post()
+    return web.HTTPBadRequest(text='Unsupported Content_Type: %s' % (request.content_type))
+
+
+# 按url处理函数的签名生成专用的参数绑定函数，注册路由时生成一次：
+# 路径中的参数从match_info读取，其余强制关键字参数GET时从查询字符串、POST时从请求体读取，
+# 直接以关键字参数调用fn，不再每次请求判断参数类型和构造中间的dict。
+# method或path为None时（未通过@get/@post注册），在请求时判断请求方法和路径参数
+def gen_binder(fn, method=None, path=None):
+    namespace = dict(_fn=fn, _APIError=APIError, _read_body=read_body, _BadRequest=web.HTTPBadRequest,
+                     _Response=web.StreamResponse, _missing=object())
+    params = inspect.signature(fn).parameters
+    path_args = None if path is None else set(_RE_PATH_ARG.findall(path))
+    var_kw = has_var_kw_arg(fn)
+    named = get_named_kw_args(fn)
+    lines = ['async def bind(request):']
+    args = []
+    # 只有需要路径以外的关键字参数时才读取查询字符串或请求体
+    if var_kw or [n for n in named if path_args is None or n not in path_args]:
+        if method == 'GET':
+            lines.append('    params = request.query')
+        elif method == 'POST':
+            lines.append('    params = await _read_body(request)')
+            lines.append('    if isinstance(params, _Response):')
+            lines.append('        return params')
+        elif method is None:
+            lines.append('    if request.method == \'POST\':')
+            lines.append('        params = await _read_body(request)')
+            lines.append('        if isinstance(params, _Response):')
+            lines.append('            return params')
+            lines.append('    elif request.method == \'GET\':')
+            lines.append('        params = request.query')
+            lines.append('    else:')
+            lines.append('        params = {}')
+        else:
+            lines.append('    params = {}')
+    if path_args is None or path_args:
+        lines.append('    match_info = request.match_info')
+    for name, param in params.items():
+        if name == 'request':
+            args.append('request=request')
+            continue
+        if param.kind not in (inspect.Parameter.POSITIONAL_OR_KEYWORD, inspect.Parameter.KEYWORD_ONLY):
+            continue
+        required = param.default is inspect.Parameter.empty
+        if not required:
+            namespace['_d_' + name] = param.default
+        if path_args is not None and name in path_args:
+            # 路径中的参数优先
+            args.append('%s=match_info[%r]' % (name, name))
+        elif param.kind == inspect.Parameter.KEYWORD_ONLY:
+            if path_args is None:
+                lines.append('    v_%s = match_info.get(%r, _missing)' % (name, name))
+                lines.append('    if v_%s is _missing:' % name)
+                lines.append('        v_%s = params.get(%r, _missing)' % (name, name))
+            elif not required:
+                args.append('%s=params.get(%r, _d_%s)' % (name, name, name))
+                continue
+            else:
+                lines.append('    v_%s = params.get(%r, _missing)' % (name, name))
+            lines.append('    if v_%s is _missing:' % name)
+            if required:
+                # 若request没有提供无默认值的强制关键字参数需要的值，报错
+                lines.append('        return _BadRequest(text=%r)' % ('Missing argument: %s' % name))
+            else:
+                lines.append('        v_%s = _d_%s' % (name, name))
+            args.append('%s=v_%s' % (name, name))
+        elif path_args is None:
+            # 未知路径时，非强制关键字参数只能来自match_info
+            lines.append('    if %r in match_info:' % name)
+            lines.append('        v_%s = match_info[%r]' % (name, name))
+            lines.append('    else:')
+            lines.append('        v_%s = _d_%s' % (name, name) if not required else '        return _BadRequest(text=%r)' % ('Missing argument: %s' % name))
+            args.append('%s=v_%s' % (name, name))
+    if var_kw:
+        # **kw接收全部参数，路径中的参数覆盖同名参数
+        lines.append('    kw = dict(params)')
+        if path_args is None or path_args:
+            lines.append('    kw.update(match_info)')
+        for arg in args:
+            lines.append('    kw[%r] = %s' % tuple(arg.split('=', 1)))
+        call = '_fn(**kw)'
+    else:
+        call = '_fn(%s)' % ', '.join(args)
+    lines.append('    try:')
+    lines.append('        return %s%s' % ('await ' if inspect.iscoroutinefunction(fn) else '', call))
+    lines.append('    except _APIError as e:')
+    lines.append('        return dict(error=e.error, data=e.data, message=e.message)')
+    src = '\n'.join(lines)
+    logging.debug('generated binder for %s:\n%s' % (fn.__name__, src))
+    exec(compile(src, '<coroweb:%s>' % fn.__name__, 'exec'), namespace)
+    return namespace['bind']
+
+
+# 路由的类别：static为静态文件，page为页面，api为接口，anonymous为不需要登录用户的页面或接口
+ROUTE_CLASSES = ('static', 'page', 'api', 'anonymous')
+
+
+# 声明middleware适用的路由类别，未声明的middleware适用于除static外的所有路由
+def middleware(*route_classes):
+    def decorator(factory):
+        factory.__routes__ = frozenset(route_classes)
+        return factory
+    return decorator
+
+
+# 推断路由的类别：/manage/下的页面需要检查管理员，没有request参数的处理函数不会读取登录用户
+def route_class(fn):
+    explicit = getattr(fn, '__route_class__', None)
+    if explicit is not None:
+        return explicit
+    path = getattr(fn, '__route__', None) or ''
+    if path.startswith('/manage/'):
+        return 'page'
+    if 'request' not in inspect.signature(fn).parameters:
+        return 'anonymous'
+    return 'api' if path.startswith('/api/') else 'page'
+
+
+# 封装一个URL处理函数，注册时生成参数绑定函数
 class RequestHandler(object):
 
-    # fn是一个url处理函数，获取其需要的参数
     def __init__(self, app, fn):
         self._app = app
         self._func = fn
-        self._has_request_args = has_request_args(fn)
-        self._has_var_kw_args = has_var_kw_arg(fn)
-        self._has_named_kw_args = has_named_kw_arg(fn)
-        self._name_kw_args = get_named_kw_args(fn)
-        self._required_kw_args = get_required_kw_args(fn)
+        self.timeout = getattr(fn, '__timeout__', None)
+        self.route_class = route_class(fn)
+        # 检查request参数的位置
+        has_request_args(fn)
+        self._bind = gen_binder(fn, getattr(fn, '__method__', None), getattr(fn, '__route__', None))
+        self._handle = self._bind
+
+    # 按路由类别组合middleware，只在启动时执行一次，列表中第一个middleware在最外层
+    async def compose(self, app, middlewares):
+        applied = [m for m in middlewares if self.route_class in getattr(m, '__routes__', ROUTE_CLASSES[1:])]
+        handler = self._bind
+        for factory in reversed(applied):
+            handler = await factory(app, handler)
+        self._handle = handler
+        return applied
 
     # 定义一个__call__方法，可以将RequestHandler类的实例视为函数，传入的参数为request
-    @asyncio.coroutine
-    def __call__(self, request):
-        kw = None
-        if self._has_var_kw_args or self._has_named_kw_args or self._required_kw_args:
-            # 对于POST方法
-            if request.method == 'POST':
-                # 必须要有数据提交格式
-                if not request.content_type:
-                    return web.HTTPBadRequest(text='Missing Content-Type')
-                ct = request.content_type.lower()
-                # 对于JSON格式的处理
-                if ct.startswith('application/json'):
-                    # decode为JSON dict，保存到params
-                    params = yield from request.json()
-                    if not isinstance(params, dict):
-                        return web.HTTPBadRequest(text='JSON body must be object.')
-                    kw = params
-                elif ct.startswith('application/x-www-form-urlencoded') or ct.startswith('multipart/form-data'):
-                    # 对于以上两种格式，直接用post函数获取，并格式化为字典
-                    params = yield from request.post()
-                    kw = dict(**params)
-                else:
-                    return web.HTTPBadRequest(text='Unsupported Content_Type: %s' % (request.content_type))
-            if request.method == 'GET':
-                # 获取url中的query部分
-                qs = request.query_string
-                if qs:
-                    kw = dict()
-                    # 解析查询字符串，作为字典返回，key为变量名，value为变量值
-                    for k, v in parse.parse_qs(qs, True).items():
-                        kw[k] = v[0]
-        if kw is None:
-            # match_info会返回一个包含request所有keyword_only类型参数的字典
-            kw = dict(**request.match_info)
-        else:
-            # 若url处理函数不包含关键字参数，包含强制关键字参数,只保留kw从request获取的强制关键字参数和值
-            if not self._has_var_kw_args and self._name_kw_args:
-                copy = dict()
-                # 仅保留强制关键字参数
-                for name in self._name_kw_args:
-                    if name in kw:
-                        copy[name] = kw[name]
-                kw = copy
-            # 检查request是否包含最新的强制关键字参数
-            for k, v in request.match_info.items():
-                if k in kw:
-                    logging.warning('Duplicate arg name in named arg and kw args: %s' % k)
-                kw[k] = v
-        # 若url处理函数需要request参数，将request传入
-        if self._has_request_args:
-            kw['request'] = request
-        # 若request没有提供无默认值的强制关键字参数需要的值，报错
-        if self._required_kw_args:
-            for name in self._required_kw_args:
-                if name not in kw:
-                    return web.HTTPBadRequest(text='Missing argument: %s' % name)
-        logging.info('call with args: %s' % str(kw))
-        # 将收集好的kw传递给fn处理函数，异步调用
-        try:
-            r = yield from self._func(**kw)
-            return r
-        except APIError as e:
-            return dict(error=e.error, data=e.data, message=e.message)
+    async def __call__(self, request):
+        return await self._handle(request)
 
 
 # 用于注册URL处理函数
@@ -170,8 +256,6 @@ def add_route(app, fn):
     path = getattr(fn, '__route__', None)
     if method is None or path is None:
         return ValueError('@get or @post not defined in %s.' % str(fn))
-    if not asyncio.iscoroutinefunction(fn) and not inspect.isgeneratorfunction(fn):
-        fn = asyncio.coroutine(fn)
     logging.info('add route %s %s => %s(%s)' %
                  (method, path, fn.__name__, ', '.join(inspect.signature(fn).parameters.keys())))
     # RequestHandler的实例可以被直接调用
@@ -200,6 +284,18 @@ def add_routes(app, module_name):
                 add_route(app, fn)
 
 
+# 为所有已注册的URL处理函数组合middleware，代替web.Application的middlewares参数，
+# 静态文件不经过任何middleware
+async def add_middlewares(app, middlewares):
+    for route in app.router.routes():
+        # 新版本的aiohttp会把非协程函数的handler再包装一层，原handler保存在__wrapped__
+        handler = getattr(route.handler, '__wrapped__', route.handler)
+        if isinstance(handler, RequestHandler):
+            applied = await handler.compose(app, middlewares)
+            logging.info('compose %s %s (%s): %s' % (route.method, route.resource.canonical, handler.route_class,
+                                                     ', '.join(m.__name__ for m in applied)))
+
+
 # 静态文件路径
 def add_static(app, path=None):
     if path:
@@ -1,14 +1,15 @@
 # -*- coding: utf-8 -*-
-import asyncio
 import time
 import re
 import hashlib
-import json
 import logging
 
 from coroweb import get, post
+from db import orm
 from db.models import User, Blog, Comment,next_id
-from apis import APIError, APIPermissionError, APIResourceNotFoundError, APIValueError, Page
+from apis import APIError, APIPermissionError, APIResourceNotFoundError, APIValueError, Page, decode_cursor
+from jsonenc import dumps
+from sessions import SessionCache, SessionVersions, TOKEN_PREFIX, sign_token, verify_token
 from aiohttp import web
 from config.config import configs
 from markdown2 import markdown
@@ -17,10 +18,73 @@ _RE_EMAIL = re.compile(r'^[a-zA-Z0-9._-]+@([a-zA-Z0-9_-])+(\.[a-zA-Z0-9_-]+){1,4
 _RE_SHA1 = re.compile(r'^[0-9a-f]{40}$')
 COOKIE_NAME = 'zdblog'
 _COOKIE_KEY = configs['session']['secret']
+# 已验证的cookie => 用户信息，命中时不再查询数据库和计算sha1
+_sessions = SessionCache(configs['session']['cache_size'], configs['session']['cache_ttl'])
 
 
-# 返回一个COOKIE_NAME对应的值
-def user2cookie(user, max_age):
+
+# 读取会话版本号大于0的用户
+async def _load_session_versions():
+    return await orm.select('select `id`, `session_version` from `users` where `session_version` > ?', [0], tuples=True)
+
+
+# 用户当前的会话版本号，用于验证签名token，定期批量刷新
+_versions = SessionVersions(_load_session_versions, configs['session']['refresh_interval'])
+# 使用token时users表有session_version列，User.update()修改密码或权限时增加版本号
+User.__session_version__ = configs['session']['format'] == 'token'
+
+
+# 用户被修改或删除时（事务中为提交之后），使其会话缓存失效；使用token时该用户的版本号标记为未知，
+# 下次验证时查询数据库，无法确定用户时刷新所有版本号
+def _user_written(model, uid):
+    if model is User:
+        _sessions.invalidate(uid)
+        if configs['session']['format'] == 'token':
+            if uid is None:
+                _versions.schedule()
+            else:
+                _versions.invalidate(uid)
+
+
+orm.add_write_listener(_user_written)
+
+
+# 启动时读取会话版本号并定期刷新
+async def init_sessions():
+    await _versions.refresh()
+    _versions.start()
+
+
+def session_stats():
+    return _sessions.stats()
+
+
+# 使用户所有已签发的登录token失效
+async def revoke_sessions(uid):
+    rows = await orm.execute('update `users` set `session_version`=`session_version`+1 where `id`=?', [uid])
+    orm.notify_write(User, uid)
+    return rows
+
+
+async def _current_version(uid):
+    rows = await orm.select('select `session_version` from `users` where `id`=?', [uid], tuples=True)
+    version = rows[0][0] if rows else 0
+    _versions.set(uid, version)
+    return version
+
+# 列表页使用的查询，sql在第一次使用时编译，之后每次请求只绑定分页参数，
+# 排序与keyset游标(created_at, id)一致，博客列表不读取正文，
+# 列表只用于展示，以紧凑的Record返回
+_BLOGS_BY_DATE = Blog.query().project('card').compact().order('created_at desc, id desc')
+_COMMENTS_BY_DATE = Comment.query().compact().order('created_at desc, id desc')
+_USERS_BY_DATE = User.query().compact().order('created_at desc, id desc')
+
+
+# 返回一个COOKIE_NAME对应的值，session.format为token时返回签名token，验证时不需要查询数据库，
+# token的版本号在签发时从数据库读取
+async def user2cookie(user, max_age):
+    if configs['session']['format'] == 'token':
+        return sign_token(_COOKIE_KEY, user, await _current_version(user.id), time.time() + max_age)
     # 计算到期时间
     expires = str(time.time() + max_age)
     s = '%s-%s-%s-%s' % (user.id, user.passwd, expires, _COOKIE_KEY )
@@ -35,10 +99,14 @@ def text2html(text):
     return ''.join(lines)
 
 # 解析cookie，返回user对象
-@asyncio.coroutine
-def cookie2user(cookie_str):
+async def cookie2user(cookie_str):
     if not cookie_str:
         return None
+    if cookie_str.startswith(TOKEN_PREFIX):
+        return await _token2user(cookie_str)
+    cached = _sessions.get(cookie_str)
+    if cached is not None:
+        return User(**cached)
     try:
         L = cookie_str.split('-')
         if len(L) != 3:
@@ -46,7 +114,8 @@ def cookie2user(cookie_str):
         uid, expires, sha1 = L
         if float(expires) < time.time():
             return None
-        user = yield from User.find(uid)
+        generation = _sessions.generation
+        user = await User.find(uid)
         if not user:
             return None
         # 根据cookie的uid，找到对应的user，根据user信息，组织字符串，再与cookie的最后一个字段比较
@@ -54,13 +123,34 @@ def cookie2user(cookie_str):
         if sha1 != hashlib.sha1(s.encode('utf-8')).hexdigest():
             logging.info('invalid sha1')
             return None
+        # user可能来自请求作用域的identity map，返回副本，避免修改共享的实例
+        user = User(**user)
         user.passwd = "******"
+        _sessions.put(cookie_str, uid, dict(user), float(expires), generation)
         return user
+    except (orm.PoolTimeoutError, orm.QueryTimeoutError):
+        raise
     except Exception as e:
         logging.exception(e)
         return None
 
 
+# 验证签名token，会话版本号与当前版本一致时有效，不查询数据库；
+# token的版本号更大或本进程的版本号未知时，查询一次该用户的版本号
+async def _token2user(token):
+    user = verify_token(_COOKIE_KEY, token)
+    if user is None:
+        return None
+    version = user.pop('version')
+    current = _versions.get(user['id'])
+    if current is None or version > current:
+        current = await _current_version(user['id'])
+    if version != current:
+        logging.info('revoked session token')
+        return None
+    return User(passwd='******', **user)
+
+
 # 检查目前登录用户是否为admin
 def check_admin(request):
     if request.__user__ is None or not request.__user__.admin:
@@ -79,18 +169,35 @@ def get_page_index(page_str):
     return p
 
 
+# 取出当前页的记录，带游标时使用keyset分页，代价与页码无关，否则按offset分页，
+# 并在page上设置前后页的游标
+async def fetch_page(query, page, cursor=None):
+    if cursor:
+        direction, values = decode_cursor(cursor)
+        try:
+            query = query.seek(**{direction: values})
+        except ValueError:
+            # 值的个数与keyset的列数不同
+            raise APIValueError('cursor', 'invalid cursor.')
+        items = await query.limit(page.limit).all()
+    else:
+        items = await query.limit(page.offset, page.limit).all()
+    if items:
+        page.set_cursors(items[0].getKeyset(), items[-1].getKeyset())
+    return items
+
+
 # 首页渲染
 @get('/')
-@asyncio.coroutine
-def index(request, * ,page='1'):
+async def index(request, *, page='1', cursor=None):
     page_index = get_page_index(page)
-    num = yield from Blog.findNumber('count(id)')
+    num = await Blog.query().number('count(id)')
     logging.info('The number of blogs in index: %s' % num)
     page = Page(num, page_index)
     if num == 0:
         blogs = []
     else:
-        blogs = yield from Blog.findAll(orderBy='created_at desc', limit=(page.offset, page.limit))
+        blogs = await fetch_page(_BLOGS_BY_DATE, page, cursor)
     return {
         '__template__': 'blogs.html',
         'blogs': blogs,
@@ -117,8 +224,7 @@ def signin():
 
 # 用户注册api
 @post('/api/users')
-@asyncio.coroutine
-def api_register_user(*, email, name, passwd):
+async def api_register_user(*, email, name, passwd):
     # 检查是否传入参数，以及是否与相应的正则表达式匹配
     if not name or not name.strip():
         raise APIValueError('name')
@@ -127,7 +233,7 @@ def api_register_user(*, email, name, passwd):
     if not passwd or not _RE_SHA1.match(passwd):
         raise APIValueError('passwd')
     # 检查是否已经注册过
-    users = yield from User.findAll('email=?', [email])
+    users = await User.findAll('email=?', [email])
     if len(users) > 0:
         raise APIError('register:failed', 'email', 'Email is already in use.')
     uid = next_id()
@@ -136,27 +242,25 @@ def api_register_user(*, email, name, passwd):
     # 构造sql语句，保存到数据库
     user = User(id=uid, name=name.strip(), email=email, passwd=hashlib.sha1(sha1_passwd.encode('utf-8')).hexdigest(),
                 image='http://www.gravatar.com/avatar/%s?d=mm&s=120' % hashlib.md5(email.encode('utf-8')).hexdigest())
-    yield from user.save()
+    await user.save()
     # 设置cookie
     r = web.Response()
-    r.set_cookie(COOKIE_NAME, user2cookie(user, 86400), max_age=86400, httponly=True)
-    # 这里的passwd是个fake值
-    user.passwd = '******'
+    r.set_cookie(COOKIE_NAME, await user2cookie(user, 86400), max_age=86400, httponly=True)
+    # dumps不会输出passwd
     r.content_type = 'application/json'
-    r.body = json.dumps(user, ensure_ascii=False).encode('utf-8')
+    r.body = dumps(user)
     return r
 
 
 # 用户登录api
 @post('/api/authenticate')
-@asyncio.coroutine
-def authenticate(*, email, passwd):
+async def authenticate(*, email, passwd):
     if not email:
         raise APIValueError('email')
     if not passwd:
         raise APIValueError('passwd')
     # 根据email取出相应的用户
-    users = yield from User.findAll(where='email=?', args=[email])
+    users = await User.findAll(where='email=?', args=[email])
     if len(users) == 0:
         raise APIValueError('email', 'email not exist.')
     user = users[0]
@@ -169,15 +273,15 @@ def authenticate(*, email, passwd):
         raise APIValueError('passwd', 'Invalid password.')
     # 认证通过，设置cookie
     r = web.Response()
-    r.set_cookie(COOKIE_NAME, user2cookie(user, 86400), max_age=86400, httponly=True)
-    user.passwd = '******'
+    r.set_cookie(COOKIE_NAME, await user2cookie(user, 86400), max_age=86400, httponly=True)
     r.content_type = 'application/json'
-    r.body = json.dumps(user, ensure_ascii=False).encode('utf-8')
+    r.body = dumps(user)
     return r
 
 
 # 登出
-@get('/signout')
+# 只读取Referer，不需要查询登录用户
+@get('/signout', route_class='anonymous')
 def signout(request):
     # 获取链接页面
     referer = request.headers.get('Referer')
@@ -190,9 +294,9 @@ def signout(request):
 
 # 获取博客详细内容api，截留blogs/后面的内容作为参数id
 @get('/blog/{id}')
-def get_blog(request, *, id):
-    blog = yield from Blog.find(id)
-    comments = yield from Comment.findAll('blog_id=?', [id], orderBy='created_at desc')
+async def get_blog(request, *, id):
+    blog = await Blog.find(id)
+    comments = await Comment.findAll('blog_id=?', [id], orderBy='created_at desc')
     # 格式化为符合html的文本
     for c in comments:
         c.html_content = text2html(c.content)
@@ -265,95 +369,86 @@ def manage_users(request, *, page='1'):
 
 # 获取某一页所显示的评论api
 @get('/api/comments')
-@asyncio.coroutine
-def api_comments(*, page='1'):
+async def api_comments(*, page='1', cursor=None):
     page_index = get_page_index(page)
     # 评论数
-    num = yield from Comment.findNumber('count(id)')
+    num = await Comment.query().number('count(id)')
     # 计算评论页
     p = Page(num, page_index)
     # 无评论，返回空字典
     if num == 0:
         return dict(page=p, comments=())
-    comments = yield from Comment.findAll(orderBy='created_at desc', limit=(p.offset, p.limit))
+    comments = await fetch_page(_COMMENTS_BY_DATE, p, cursor)
     logging.info('The number of comments in manage: %s' % len(comments))
     return dict(page=p, comments=comments)
 
 
 # 评论创建api
 @post('/api/blogs/{id}/comments')
-@asyncio.coroutine
-def api_create_comment(id, request, *, content):
+async def api_create_comment(id, request, *, content):
     user = request.__user__ #登录再说
     if not user:
         raise APIPermissionError('Please signin first.')
     if not content or not content.strip():
         raise APIValueError('content', 'content cannot be empty.')
-    blog = yield from Blog.find(id)
+    blog = await Blog.find(id)
     if blog is None:
         raise APIResourceNotFoundError('Blog')
     comment = Comment(blog_id=blog.id, user_id=user.id, user_name=user.name, user_image=user.image, content=content.strip())
-    yield from comment.save()
+    await comment.save()
     return comment
 
 
 # 评论删除api
 @post('/api/comments/{id}/delete')
-@asyncio.coroutine
-def api_delete_comments(id, request):
+async def api_delete_comments(id, request):
     check_admin(request)
-    c = yield from Comment.find(id)
+    c = await Comment.find(id)
     if c is None:
         raise APIResourceNotFoundError('Comment')
-    yield from c.remove()
+    await c.remove()
     return dict(id=id)
 
 
 # 用户列表api
 @get('/api/users')
-@asyncio.coroutine
-def api_get_users(*, page='1'):
+async def api_get_users(*, page='1', cursor=None):
     page_index = get_page_index(page)
-    num = yield from User.findNumber('count(id)')
+    num = await User.findNumber('count(id)')
     p = Page(num, page_index)
     if num == 0:
         return dict(page=p, users=())
-    users = yield from User.findAll(orderBy='created_at desc', limit=(p.offset, p.limit))
+    users = await fetch_page(_USERS_BY_DATE, p, cursor)
     logging.info('The number of users in manage: %s' % len(users))
-    for u in users:
-        u.passwd = '******'
     return dict(page=p, users=users)
 
 
 # 获取博客列表api
 @get('/api/blogs')
-@asyncio.coroutine
-def api_blogs(*, page='1'):
+async def api_blogs(*, page='1', cursor=None):
     # 把page转化为整型
     page_index = get_page_index(page)
     # 查询日志条数
-    num = yield from Blog.findNumber('count(id)')
+    num = await Blog.query().number('count(id)')
     p = Page(num, page_index)
     if num == 0:
         return dict(page=p, blogs=())
     # 根据limit选出当前页展示的博客
-    blogs = yield from Blog.findAll(orderBy='created_at desc',limit=(p.offset, p.limit))
+    blogs = await fetch_page(_BLOGS_BY_DATE, p, cursor)
     logging.info('The number of blogs in manage: %s' % len(blogs))
     return dict(page=p, blogs=blogs)
 
 
 # 获取单个博客api
 @get('/api/blogs/{id}')
-@asyncio.coroutine
-def api_get_blog(*, id):
-    blog = yield from Blog.find(id)
+async def api_get_blog(*, id):
+    blog = await Blog.find(id)
     return blog
 
 
 # 博客创建api
 @post('/api/blogs')
-@asyncio.coroutine
-def api_create_blogs(request, *, name, summary, content):
+async def api_create_blogs(request, *, name, summary, content):
     check_admin(request)
     if not name or not name.strip():
         raise APIValueError('name', 'name cannot be empty.')
@@ -363,16 +458,15 @@ def api_create_blogs(request, *, name, summary, content):
         raise APIValueError('content', 'content cannot be empty.')
     blog = Blog(user_id=request.__user__.id, user_name=request.__user__.name, user_image=request.__user__.image,
                 name=name.strip(), summary=summary.strip(), content=content.strip())
-    yield from blog.save()
+    await blog.save()
     return blog
 
 
 # 更新博客api
 @post('/api/blogs/{id}')
-@asyncio.coroutine
-def api_update_blog(id, request, *, name, summary, content):
+async def api_update_blog(id, request, *, name, summary, content):
     check_admin(request)
-    blog = yield from Blog.find(id)
+    blog = await Blog.find(id)
     if not name or not name.strip():
         raise APIValueError('name', 'name cannot be empty.')
     if not summary or not summary.strip():
@@ -382,15 +476,19 @@ def api_update_blog(id, request, *, name, summary, content):
     blog.name = name.strip()
     blog.summary = summary.strip()
     blog.content = content.strip()
-    yield from blog.update()
+    await blog.update()
     return blog
 
 
 # 删除博客
 @post('/api/blogs/{id}/delete')
-@asyncio.coroutine
-def api_delete_blog(request, *, id):
+async def api_delete_blog(request, *, id):
     check_admin(request)
-    blog = yield from Blog.find(id)
-    yield from blog.remove()
+    # 博客及其评论在同一个事务内删除，博客不存在时回滚
+    async with orm.transaction():
+        comments = await Comment.delete_where('`blog_id`=?', [id])
+        blogs = await Blog.delete_where('`id`=?', [id])
+        if blogs == 0:
+            raise APIResourceNotFoundError('Blog')
+    logging.info('removed blog %s with %s comments' % (id, comments))
     return dict(id=id)
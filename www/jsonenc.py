@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+
+"""
+API响应的JSON序列化，直接输出UTF-8编码的bytes。
+Model、Record、Page和APIError按类型各生成一次转换函数，转换结果不包含passwd列。
+安装了orjson时使用orjson，否则使用标准库json
+"""
+
+import json
+
+from apis import APIError, Page
+from db.orm import Model, Record
+
+# 任何情况下都不输出的列
+HIDDEN = frozenset(['passwd'])
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+BACKEND = 'orjson' if orjson is not None else 'json'
+
+
+def _model_dict(o):
+    d = dict(o)
+    for k in HIDDEN:
+        d.pop(k, None)
+    return d
+
+
+def _page_dict(o):
+    return dict(o.__dict__)
+
+
+def _error_dict(o):
+    return dict(error=o.error, data=o.data, message=o.message)
+
+
+def _object_dict(o):
+    if hasattr(o, '_asdict'):
+        return o._asdict()
+    return dict(o.__dict__)
+
+
+# Record的_asdict()按列生成，包含隐藏列时再去掉
+def _record_converter(cls):
+    hidden = HIDDEN.intersection(cls.__columns__)
+    if not hidden:
+        return cls._asdict
+
+    def convert(o):
+        d = o._asdict()
+        for k in hidden:
+            del d[k]
+        return d
+    return convert
+
+
+# 类型 => 转换为内置类型的函数
+_converters = dict()
+
+
+def _converter(cls):
+    convert = _converters.get(cls)
+    if convert is None:
+        if issubclass(cls, Model):
+            convert = _model_dict
+        elif issubclass(cls, Record):
+            convert = _record_converter(cls)
+        elif issubclass(cls, Page):
+            convert = _page_dict
+        elif issubclass(cls, APIError):
+            convert = _error_dict
+        elif issubclass(cls, dict):
+            convert = dict
+        else:
+            convert = _object_dict
+        _converters[cls] = convert
+    return convert
+
+
+def default(o):
+    return _converter(type(o))(o)
+
+
+# 内置的标量类型，不需要转换
+_SCALARS = frozenset([str, int, float, bool, type(None)])
+
+
+# 标准库的编码器直接输出dict的子类，不会调用default，先把Model等对象转换为内置类型。
+# 转换后的值可能还包含Model（例如blog.comments = [user]），与orjson一样继续转换，只跳过标量
+def _prepare(o):
+    cls = type(o)
+    if cls in _SCALARS:
+        return o
+    if cls is dict:
+        return dict((k, _prepare(v)) for k, v in o.items())
+    if cls is list or cls is tuple:
+        return [_prepare(v) for v in o]
+    d = _converter(cls)(o)
+    for k, v in d.items():
+        if type(v) not in _SCALARS:
+            d[k] = _prepare(v)
+    return d
+
+
+_encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'))
+
+
+# 使用标准库json序列化，未安装orjson时即为dumps，也用于对比测试
+def dumps_json(obj):
+    return _encoder.encode(_prepare(obj)).encode('utf-8')
+
+
+if orjson is not None:
+    # PASSTHROUGH_SUBCLASS使Model交给default处理，NON_STR_KEYS兼容标准库对非字符串key的处理
+    _OPTIONS = orjson.OPT_PASSTHROUGH_SUBCLASS | orjson.OPT_NON_STR_KEYS
+
+    def dumps(obj):
+        return orjson.dumps(obj, default=default, option=_OPTIONS)
+else:
+    dumps = dumps_json
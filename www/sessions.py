@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+
+"""
+登录会话：
+SessionCache为已验证的登录cookie缓存：cookie => 去掉密码的用户信息，按最近使用淘汰，
+过期时间为cookie的过期时间和ttl中较早的一个。同一进程内User的写入（事务中为提交之后）会使该用户的缓存失效，
+其他进程或直接修改数据库的变化在ttl之后生效。
+sign_token/verify_token为无状态的签名token，包含模板需要的用户信息和会话版本号，
+SessionVersions定期批量读取用户当前的会话版本号，版本号增加后旧的token失效
+"""
+
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import time
+from collections import OrderedDict
+
+# token的格式为 v1.<base64的用户信息>.<base64的签名>
+TOKEN_PREFIX = 'v1.'
+
+
+class SessionCache(object):
+
+    def __init__(self, max_entries=10000, ttl=60.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        # 失效的次数，查询用户之前获取，查询期间有失效时不缓存查到的旧数据
+        self.generation = 0
+        # cookie => (过期时间, uid, 用户信息)，按最近使用排序
+        self._entries = OrderedDict()
+        # uid => 该用户的所有cookie
+        self._users = dict()
+
+    def get(self, cookie):
+        entry = self._entries.get(cookie)
+        if entry is None:
+            self.misses += 1
+            return None
+        if entry[0] < time.time():
+            self._remove(cookie)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(cookie)
+        self.hits += 1
+        return entry[2]
+
+    # expires为cookie的过期时间，generation为查询用户之前的self.generation
+    def put(self, cookie, uid, user, expires, generation=None):
+        if generation is not None and generation != self.generation:
+            return
+        if cookie in self._entries:
+            self._remove(cookie)
+        self._entries[cookie] = (min(expires, time.time() + self.ttl), uid, user)
+        self._users.setdefault(uid, set()).add(cookie)
+        while len(self._entries) > self.max_entries:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def _remove(self, cookie):
+        expires, uid, user = self._entries.pop(cookie)
+        cookies = self._users.get(uid)
+        if cookies is not None:
+            cookies.discard(cookie)
+            if not cookies:
+                del self._users[uid]
+
+    # 使某个用户的所有会话失效，uid为None时清空缓存
+    def invalidate(self, uid=None):
+        self.generation += 1
+        if uid is None:
+            self.invalidations += len(self._entries)
+            self._entries.clear()
+            self._users.clear()
+            return
+        for cookie in list(self._users.get(uid, ())):
+            self._remove(cookie)
+            self.invalidations += 1
+
+    def stats(self):
+        return dict(entries=len(self._entries), max_entries=self.max_entries, hits=self.hits, misses=self.misses,
+                    evictions=self.evictions, invalidations=self.invalidations)
+
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def _b64decode(s):
+    return base64.urlsafe_b64decode(s + '=' * (-len(s) % 4))
+
+
+def _sign(secret, payload):
+    return _b64encode(hmac.new(secret.encode('utf-8'), payload.encode('ascii'), hashlib.sha256).digest())
+
+
+# 签名的内容为[id, name, image, admin, 会话版本号, 过期时间]
+def sign_token(secret, user, version, expires):
+    payload = _b64encode(json.dumps([user.id, user.name, user.image, bool(user.admin), version, expires],
+                                    ensure_ascii=False, separators=(',', ':')).encode('utf-8'))
+    return '%s%s.%s' % (TOKEN_PREFIX, payload, _sign(secret, payload))
+
+
+# 验证签名和过期时间，返回dict(id, name, image, admin, version)，无效时返回None
+def verify_token(secret, token):
+    try:
+        payload, signature = token[len(TOKEN_PREFIX):].split('.')
+        if not hmac.compare_digest(signature, _sign(secret, payload)):
+            return None
+        uid, name, image, admin, version, expires = json.loads(_b64decode(payload).decode('utf-8'))
+    except (ValueError, TypeError):
+        return None
+    if expires < time.time():
+        return None
+    return dict(id=uid, name=name, image=image, admin=admin, version=version)
+
+
+# 用户当前的会话版本号，load为批量读取的协程函数，返回(uid, 版本号)，
+# 只需要返回版本号大于0的用户，未出现的用户版本号为0，版本号为None时表示未知，需要查询数据库
+class SessionVersions(object):
+
+    def __init__(self, load, interval=30.0):
+        self.load = load
+        self.interval = interval
+        self.versions = dict()
+        self._task = None
+        self._pending = None
+        self._again = False
+        # 刷新期间被set或invalidate修改过的uid，刷新结果不能覆盖它们
+        self._touched = None
+
+    def get(self, uid):
+        return self.versions.get(uid, 0)
+
+    def set(self, uid, version):
+        self.versions[uid] = version
+        if self._touched is not None:
+            self._touched.add(uid)
+
+    # 用户被修改后标记其版本号未知，下次验证token时查询数据库，不需要等待刷新
+    def invalidate(self, uid):
+        self.set(uid, None)
+
+    async def refresh(self):
+        self._touched = set()
+        try:
+            versions = dict(await self.load())
+        finally:
+            touched, self._touched = self._touched, None
+        for uid, version in self.versions.items():
+            if version is None or uid in touched:
+                versions[uid] = version
+        self.versions = versions
+
+    # 尽快刷新，同一时间只刷新一次，刷新期间再次调用时在本次完成后再刷新一次，
+    # 保证读到调用之前提交的修改
+    def schedule(self):
+        if self._pending is not None and not self._pending.done():
+            self._again = True
+        else:
+            self._pending = asyncio.ensure_future(self._refresh_logged())
+        return self._pending
+
+    async def _refresh_logged(self):
+        self._again = True
+        while self._again:
+            self._again = False
+            try:
+                await self.refresh()
+            except Exception as e:
+                logging.exception(e)
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+
+    async def _run(self):
+        while True:
+            await self.schedule()
+            await asyncio.sleep(self.interval)